@@ -0,0 +1,154 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+# Index of the methods each zerorpc service exposes, built
+# from _zerorpc_inspect and kept in process and on disk.
+#
+# entries are keyed by endpoint and dropped when the consul
+# catalog index changes (services registered, moved or
+# restarted) or after CACHE_TTL seconds
+#
+# services that answered but could not be inspected, ie a
+# remote error raised by _zerorpc_inspect, are entered with
+# methods None: they may expose any method
+
+import os
+import threading
+import time
+from ma_cli import discovery
+from ma_cli import rpc_pool
+
+CACHE_TTL = 600
+CACHE_PATH = os.path.join(os.path.dirname(discovery.CACHE_PATH), "capabilities.json")
+# seconds to wait for each service and services inspected at once
+INSPECT_TIMEOUT = 5
+CONCURRENCY = 32
+# services that could not be inspected are not
+# tried again for RETRY_AFTER seconds
+RETRY_AFTER = 60
+
+_lock = threading.Lock()
+_cache = {"index" : None, "time" : 0, "endpoints" : {}, "failed" : {}}
+
+def inspect(service, timeout=INSPECT_TIMEOUT):
+    """
+    return (service, _zerorpc_inspect result or None, exception)
+    """
+    try:
+        zc = rpc_pool.clients.get((service['ip'], service['port']))
+        return service, zc._zerorpc_inspect(timeout=timeout), None
+    except Exception as ex:
+        return service, None, ex
+
+def inspect_all(services, timeout=INSPECT_TIMEOUT, concurrency=CONCURRENCY):
+    """
+    inspect services concurrently in greenlets, yields
+    (service, inspection, exception) as each answers
+    """
+    from gevent.pool import Pool
+    pool = Pool(max(1, concurrency))
+    return pool.imap_unordered(lambda service: inspect(service, timeout), services)
+
+def load(index):
+    # in process entries first, then the shared file
+    if _cache["index"] != index or time.time() - _cache["time"] > CACHE_TTL:
+        cached = discovery.read_cache(CACHE_PATH)
+        if cached is not None and cached["index"] == index and time.time() - cached["time"] <= CACHE_TTL:
+            _cache.update(cached)
+        else:
+            _cache.update({"index" : index, "time" : time.time(), "endpoints" : {}, "failed" : {}})
+    return _cache["endpoints"], _cache["failed"]
+
+def capabilities(services, refresh=False, timeout=INSPECT_TIMEOUT, concurrency=CONCURRENCY, errors=None, backoff=True):
+    """
+    return {endpoint : {'service', 'ip', 'port', 'methods'}} for
+    services, inspecting only those missing from the cache
+
+    services that could not be reached are left out and, if
+    errors is a dict, recorded there as {service name : error name}.
+    Unless backoff is False they are not inspected again for
+    RETRY_AFTER seconds
+    """
+    services = list(services)
+    index = discovery.catalog_index()
+    with _lock:
+        if refresh:
+            _cache.update({"index" : index, "time" : time.time(), "endpoints" : {}, "failed" : {}})
+        endpoints, failed = load(index)
+        now = time.time()
+        missing = []
+        for s in services:
+            endpoint = rpc_pool.endpoint(s['ip'], s['port'])
+            if endpoint in endpoints:
+                continue
+            if backoff and endpoint in failed and now - failed[endpoint][0] < RETRY_AFTER:
+                if errors is not None:
+                    errors[s['service']] = failed[endpoint][1]
+                continue
+            missing.append(s)
+
+        if missing:
+            import zerorpc
+            for service, inspection, ex in inspect_all(missing, timeout, concurrency):
+                endpoint = rpc_pool.endpoint(service['ip'], service['port'])
+                if isinstance(ex, zerorpc.RemoteError):
+                    failed.pop(endpoint, None)
+                    endpoints[endpoint] = {
+                        "service" : service['service'],
+                        "ip" : service['ip'],
+                        "port" : service['port'],
+                        "methods" : None,
+                        "error" : ex.name}
+                    continue
+                if ex is not None:
+                    name = getattr(ex, "name", type(ex).__name__)
+                    failed[endpoint] = (time.time(), name)
+                    if errors is not None:
+                        errors[service['service']] = name
+                    continue
+                failed.pop(endpoint, None)
+                endpoints[endpoint] = {
+                    "service" : service['service'],
+                    "ip" : service['ip'],
+                    "port" : service['port'],
+                    "methods" : inspection['methods']}
+            discovery.write_cache(_cache, CACHE_PATH)
+
+        wanted = set(rpc_pool.endpoint(s['ip'], s['port']) for s in services)
+        return {endpoint : entry for endpoint, entry in endpoints.items() if endpoint in wanted}
+
+def cached(services):
+    """
+    return the cached entries for services without
+    inspecting any of them
+    """
+    index = discovery.catalog_index()
+    with _lock:
+        endpoints, _ = load(index)
+        wanted = set(rpc_pool.endpoint(s['ip'], s['port']) for s in services)
+        return {endpoint : entry for endpoint, entry in endpoints.items() if endpoint in wanted}
+
+def providers(services, method, **kwargs):
+    """
+    return the services exposing method or whose methods
+    are unknown, in the order given
+    """
+    services = list(services)
+    exposed = capabilities(services, **kwargs)
+    provided = []
+    for s in services:
+        entry = exposed.get(rpc_pool.endpoint(s['ip'], s['port']))
+        if entry is not None and (entry["methods"] is None or method in entry["methods"]):
+            provided.append(s)
+    return provided
+
+def invalidate():
+    with _lock:
+        _cache.update({"index" : None, "time" : 0, "endpoints" : {}, "failed" : {}})
+        try:
+            os.remove(CACHE_PATH)
+        except OSError:
+            pass
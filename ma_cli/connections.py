@@ -0,0 +1,170 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import threading
+import redis
+from ma_cli import local_tools
+from ma_cli import discovery
+
+# connections per pool, threads wait up to
+# POOL_TIMEOUT seconds for a free connection
+# once all are in use
+MAX_CONNECTIONS = 32
+POOL_TIMEOUT = 20
+# None blocks indefinitely on reads
+SOCKET_TIMEOUT = None
+SOCKET_CONNECT_TIMEOUT = 5
+# idle connections are pinged before reuse
+HEALTH_CHECK_INTERVAL = 30
+
+class ServiceNotFound(redis.exceptions.ConnectionError):
+    pass
+
+class ConnectionManager(object):
+    """Lazily created redis clients for a consul service
+
+    nothing is looked up or connected until text or binary is
+    first used. Both clients share one pooling policy: a bounded
+    blocking pool each, created with the same size and timeouts.
+    redis-py decodes responses per connection so text and binary
+    clients cannot draw from the same pool.
+
+    connection errors are not retried, call reconnect() to drop
+    the pools and, if the address came from consul, look the
+    service up again on next use. Clients are also recreated
+    when a refreshed service list moves the service elsewhere
+    """
+    def __init__(self,
+                 service="redis",
+                 host=None,
+                 port=None,
+                 max_connections=MAX_CONNECTIONS,
+                 pool_timeout=POOL_TIMEOUT,
+                 socket_timeout=SOCKET_TIMEOUT,
+                 socket_connect_timeout=SOCKET_CONNECT_TIMEOUT,
+                 health_check_interval=HEALTH_CHECK_INTERVAL):
+        self.service = service
+        self.host = host
+        self.port = port
+        # only addresses found through consul are re-resolved
+        self.resolved = host is None
+        # bypass the discovery cache after a reconnect
+        self.refresh = False
+        # catalog index the address was looked up at
+        self.index = None
+        self.settings = {"max_connections" : max_connections,
+                         "timeout" : pool_timeout,
+                         "socket_timeout" : socket_timeout,
+                         "socket_connect_timeout" : socket_connect_timeout,
+                         "health_check_interval" : health_check_interval}
+        self._lock = threading.RLock()
+        self._text = None
+        self._binary = None
+
+    def address(self):
+        """
+        return (host, port), looking the service up if needed
+        """
+        with self._lock:
+            if self.host is None:
+                try:
+                    max_age = 0 if self.refresh else discovery.CACHE_TTL
+                    host, port = local_tools.lookup(self.service, max_age)
+                except Exception as ex:
+                    raise ServiceNotFound("could not look up service {}: {}".format(self.service, ex))
+                if host is None:
+                    raise ServiceNotFound("service {} not found".format(self.service))
+                self.host, self.port = host, port
+                self.index = discovery.catalog_index()
+                self.refresh = False
+            return self.host, self.port
+
+    def _moved(self):
+        # cheap check run on every use, the service list
+        # is only searched once the catalog has changed
+        return self.resolved and self.host is not None and self.index != discovery.catalog_index()
+
+    def follow(self):
+        """
+        reconnect if the service list has been refreshed
+        and lists the service at another address
+        """
+        with self._lock:
+            if not self._moved():
+                return
+            try:
+                host, port = local_tools.lookup(self.service)
+            except Exception as ex:
+                host, port = None, None
+                print("could not look up service {}: {}".format(self.service, ex))
+            self.index = discovery.catalog_index()
+            if host is not None and (host, port) != (self.host, self.port):
+                print("service {} moved to {}:{}".format(self.service, host, port))
+                self.disconnect()
+                self.host, self.port = host, port
+
+    def _client(self, decode_responses):
+        host, port = self.address()
+        pool = redis.BlockingConnectionPool(host=host,
+                                            port=int(port),
+                                            decode_responses=decode_responses,
+                                            **self.settings)
+        return redis.StrictRedis(connection_pool=pool)
+
+    @property
+    def text(self):
+        if self._moved():
+            self.follow()
+        client = self._text
+        if client is None:
+            with self._lock:
+                if self._text is None:
+                    self._text = self._client(True)
+                client = self._text
+        return client
+
+    @property
+    def binary(self):
+        if self._moved():
+            self.follow()
+        client = self._binary
+        if client is None:
+            with self._lock:
+                if self._binary is None:
+                    self._binary = self._client(False)
+                client = self._binary
+        return client
+
+    def configure(self, **settings):
+        """
+        change pool settings, ie max_connections or socket_timeout,
+        existing pools are closed and recreated on next use
+        """
+        unknown = set(settings) - set(self.settings)
+        if unknown:
+            raise TypeError("unknown settings: {}".format(", ".join(sorted(unknown))))
+        with self._lock:
+            self.settings.update(settings)
+            self.disconnect()
+
+    def disconnect(self):
+        with self._lock:
+            for client in (self._text, self._binary):
+                if client is not None:
+                    client.connection_pool.disconnect()
+            self._text = None
+            self._binary = None
+
+    def reconnect(self):
+        """
+        drop pools and forget a looked up address, ie after
+        the service has been rescheduled on another host
+        """
+        with self._lock:
+            self.disconnect()
+            if self.resolved:
+                self.host, self.port = None, None
+                self.refresh = True
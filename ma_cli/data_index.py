@@ -0,0 +1,236 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+# Opt-in secondary indexes for hash fields, stored alongside
+# the data:
+#
+#     machinic:index:{prefix}                 (hash) field -> index type
+#     machinic:index:{prefix}:field:{field}   (sorted set)
+#     machinic:index:{prefix}:keys            (set) all indexed keys
+#     machinic:index:{prefix}:values:{field}  (hash) key -> indexed value
+#     machinic:index:{prefix}:maintained      (string) expiring heartbeat
+#
+# numeric fields are scored by value with the key as member,
+# string fields score 0 with '{value}\x00{key}' members so
+# they can be ranged lexicographically, the value each key is
+# indexed under is kept in a side hash so its member can be
+# removed when the value changes or the key is deleted.
+#
+# hashes are also written by services that do not stage index
+# changes, so indexes are only current while a maintainer
+# follows keyspace notifications for the prefix and keeps the
+# heartbeat alive. Without it readers scan instead.
+#
+# functions take a connection or pipeline so writes can be
+# staged into the same round trip as the data they index
+
+NUMERIC = "numeric"
+STRING = "string"
+INDEX_TYPES = (STRING, NUMERIC)
+SEPARATOR = "\x00"
+# seconds a maintainer's heartbeat lasts
+MAINTAINED_TTL = 10
+
+def prefix_of(key):
+    return key.split(":")[0]
+
+def pattern_prefix(pattern):
+    """
+    return prefix if pattern selects a whole prefix
+    ie 'glworb:*', otherwise None
+    """
+    if not pattern.endswith(":*"):
+        return None
+    prefix = pattern[:-2]
+    if not prefix or any(c in prefix for c in "*?[]\\:"):
+        return None
+    return prefix
+
+def registry_key(prefix):
+    return "machinic:index:{}".format(prefix)
+
+def field_key(prefix, field):
+    return "machinic:index:{}:field:{}".format(prefix, field)
+
+def keys_key(prefix):
+    return "machinic:index:{}:keys".format(prefix)
+
+def values_key(prefix, field):
+    return "machinic:index:{}:values:{}".format(prefix, field)
+
+def maintained_key(prefix):
+    return "machinic:index:{}:maintained".format(prefix)
+
+def is_current(conn, prefix):
+    """
+    True while a maintainer keeps indexes for prefix current
+    """
+    return bool(conn.exists(maintained_key(prefix)))
+
+def heartbeat(conn, prefix, ttl=MAINTAINED_TTL):
+    conn.set(maintained_key(prefix), 1, ex=ttl)
+
+def indexed_fields(conn, prefix):
+    """
+    return {field : index type} for prefix
+    """
+    return conn.hgetall(registry_key(prefix))
+
+def register(conn, prefix, field, field_type):
+    if field_type not in INDEX_TYPES:
+        raise ValueError("index type must be one of {}".format(INDEX_TYPES))
+    conn.hset(registry_key(prefix), field, field_type)
+
+def drop(conn, prefix, field):
+    pipe = conn.pipeline(transaction=False)
+    pipe.hdel(registry_key(prefix), field)
+    pipe.delete(field_key(prefix, field), values_key(prefix, field))
+    pipe.execute()
+    # drop key set along with the last index
+    if not conn.hlen(registry_key(prefix)):
+        conn.delete(keys_key(prefix), maintained_key(prefix))
+
+def score(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def member(key, value):
+    return "{}{}{}".format(value, SEPARATOR, key)
+
+def split_member(index_member):
+    value, _, key = index_member.rpartition(SEPARATOR)
+    return key, value
+
+def stage(pipe, prefix, field, field_type, key, old_value, new_value):
+    """
+    stage index changes for key's field going from old_value
+    to new_value, a value of None or "" is not indexed
+
+    old_value is only needed for string indexes and is the
+    value key is currently indexed under, see indexed_values
+    """
+    index = field_key(prefix, field)
+    if field_type == NUMERIC:
+        new_score = score(new_value) if new_value else None
+        if new_score is None:
+            pipe.zrem(index, key)
+        else:
+            pipe.zadd(index, {key : new_score})
+    else:
+        if old_value and old_value != new_value:
+            pipe.zrem(index, member(key, old_value))
+        if new_value:
+            pipe.zadd(index, {member(key, new_value) : 0})
+            pipe.hset(values_key(prefix, field), key, new_value)
+        else:
+            pipe.hdel(values_key(prefix, field), key)
+    pipe.sadd(keys_key(prefix), key)
+
+def indexed_values(conn, prefix, field, keys):
+    """
+    return {key : value key is indexed under} for a string index
+    """
+    keys = list(keys)
+    if not keys:
+        return {}
+    return dict(zip(keys, conn.hmget(values_key(prefix, field), keys)))
+
+def build(conn, prefix, field, field_type, rows, batch_size=500):
+    """
+    (re)build index for field from rows of (key, {field : value})
+    and register it, returns number of keys indexed
+    """
+    register(conn, prefix, field, field_type)
+    conn.delete(field_key(prefix, field), values_key(prefix, field))
+    indexed = 0
+    pipe = conn.pipeline(transaction=False)
+    for count, (key, fields) in enumerate(rows, 1):
+        pipe.sadd(keys_key(prefix), key)
+        if fields.get(field):
+            stage(pipe, prefix, field, field_type, key, None, fields[field])
+            indexed += 1
+        if count % batch_size == 0:
+            pipe.execute()
+    pipe.execute()
+    return indexed
+
+def members(conn, prefix, field, field_type):
+    """
+    yield indexed keys for field, unordered
+    """
+    index = field_key(prefix, field)
+    if field_type == NUMERIC:
+        for key, _ in conn.zscan_iter(index):
+            yield key
+    else:
+        # a key is listed once even if an outdated
+        # value of it has not been removed yet
+        seen = set()
+        for index_member, _ in conn.zscan_iter(index):
+            key = split_member(index_member)[0]
+            if key not in seen:
+                seen.add(key)
+                yield key
+
+def last(conn, prefix, field, field_type):
+    """
+    return (key, indexed value) with the highest value
+    for field or None if index is empty
+    """
+    index = field_key(prefix, field)
+    if field_type == NUMERIC:
+        found = conn.zrevrange(index, 0, 0, withscores=True)
+        return found[0] if found else None
+    found = conn.zrevrangebylex(index, "+", "-", start=0, num=1)
+    return split_member(found[0]) if found else None
+
+def is_value(field_type, indexed_value, value):
+    """
+    True if value is the one indexed as indexed_value
+    """
+    if not value:
+        return False
+    if field_type == NUMERIC:
+        return score(value) == indexed_value
+    return value == indexed_value
+
+def discard(conn, prefix, field, field_type, key, indexed_value):
+    """
+    remove one entry of key from the index for field
+    """
+    if field_type == NUMERIC:
+        conn.zrem(field_key(prefix, field), key)
+    else:
+        conn.zrem(field_key(prefix, field), member(key, indexed_value))
+
+def random_key(conn, prefix):
+    return conn.srandmember(keys_key(prefix))
+
+def forget(conn, prefix, key, fields=None):
+    """
+    remove a key that no longer exists from
+    the key set and all indexes
+    """
+    if fields is None:
+        fields = indexed_fields(conn, prefix)
+    string_fields = [field for field, field_type in fields.items() if field_type != NUMERIC]
+    pipe = conn.pipeline(transaction=False)
+    for field in string_fields:
+        pipe.hget(values_key(prefix, field), key)
+    values = dict(zip(string_fields, pipe.execute()))
+
+    pipe = conn.pipeline(transaction=False)
+    pipe.srem(keys_key(prefix), key)
+    for field, field_type in fields.items():
+        if field_type == NUMERIC:
+            pipe.zrem(field_key(prefix, field), key)
+        else:
+            if values[field]:
+                pipe.zrem(field_key(prefix, field), member(key, values[field]))
+            pipe.hdel(values_key(prefix, field), key)
+    pipe.execute()
@@ -5,96 +5,365 @@
 # Copyright (c) 2018, Galen Curwen-McAdams
 
 import io
+import heapq
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
+import time
 import uuid
 import random
 from contextlib import contextmanager
+from functools import lru_cache
 import redis
-from PIL import Image, ImageDraw, ImageFont, ImageShow
-from ma_cli import local_tools
-
-try:
-    r_ip, r_port = local_tools.lookup('redis')
-    redis_conn = redis.StrictRedis(host=r_ip, port=str(r_port), decode_responses=True)
-    binary_redis_conn = redis.StrictRedis(host=r_ip, port=str(r_port))
-except:
-     r_ip, r_port = None, None
-
-class FehImageViewer(ImageShow.UnixViewer):
-    def show_file(self, filename, **options):
-        # -F opens fullscreen with image scaled
-        # to fit
-        subprocess.Popen(['feh', filename, '-F'])
-        return 1
-
-#prefer feh
-ImageShow.register(FehImageViewer, order=-1)
+from ma_cli import connections
+from ma_cli import data_index
+from ma_cli import image_cache
+from ma_cli import montage
+from ma_cli import geometry
+
+# redis is looked up and connected on first use
+db = connections.ConnectionManager("redis")
+
+def __getattr__(name):
+    # names previously set at import
+    if name == "redis_conn":
+        return db.text
+    elif name == "binary_redis_conn":
+        return db.binary
+    elif name in ("r_ip", "r_port"):
+        return service_connection()[("r_ip", "r_port").index(name)]
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
+# number of commands sent per pipeline round trip
+# for bulk operations
+BATCH_SIZE = 500
+# keys requested per SCAN call, a hint to redis
+SCAN_COUNT = 1000
+# keys held in memory per sorted run by sorted_stream
+SORT_CHUNK_SIZE = 100000
+# bytes read from each end of a binary
+# to fingerprint it for the image cache
+FINGERPRINT_BYTES = 64
+
+# threads used to decode images concurrently,
+# pillow releases the gil while decoding
+DECODE_WORKERS = 4
+
+# tried in order for text overlays
+FONT_PATHS = ("DejaVuSansMono.ttf",
+              "/usr/share/fonts/truetype/freefont/DejaVuSansMono.ttf")
+
+# process-wide cache of decoded images
+decoded_images = image_cache.ImageCache()
+# rendered grid label masks, a few hundred bytes each
+GRID_LABEL_BYTES = 8 * 1024 * 1024
+grid_labels = image_cache.ImageCache(GRID_LABEL_BYTES)
+
+# pillow is imported by the functions that use it
+# so listing or editing fields does not load it
+
+@lru_cache(maxsize=1)
+def register_viewer():
+    from PIL import ImageShow
+
+    class FehImageViewer(ImageShow.UnixViewer):
+        def show_file(self, filename, **options):
+            # -F opens fullscreen with image scaled
+            # to fit
+            subprocess.Popen(['feh', filename, '-F'])
+            return 1
+
+    #prefer feh
+    ImageShow.register(FehImageViewer, order=-1)
+
+def show(img):
+    register_viewer()
+    img.show()
 
 class Default(dict):
     def __missing__(self, key):
         return "{"+key+"}"
 
 @contextmanager
-def open_image(address_uuid, key=None):
-    if key is not None:
-        bytes_key = redis_conn.hget(address_uuid, key)
-    else:
-        bytes_key = address_uuid
-
-    key_bytes = binary_redis_conn.get(bytes_key)
-    file = io.BytesIO()
-    file.write(key_bytes)
-    image = Image.open(file)
+def open_image(address_uuid, key=None, max_size=None):
+    image = load_image(binary_key(address_uuid, key), max_size)
     yield image
-    file = io.BytesIO()
     #image.save(file,image.format)
-    image.close()
-    file.seek(0)
     #binary_r.set(bytes_key, file.read())
-    file.close()
+    image.close()
 
-def add_field(field_name, uuids, values=None):
+def add_field(field_name, uuids, values=None, batch_size=BATCH_SIZE):
 
     if not values:
         values = [""]
 
     modified = []
-    for u in uuids:
-        redis_conn.hset(u, field_name, random.choice(values))
-        modified.append(u)
+    indexes = {}
+    for batch in chunked(uuids, batch_size):
+        write_field(field_name,
+                    [(u, random.choice(values)) for u in batch],
+                    indexes)
+        modified.extend(batch)
 
     return modified
 
-def range_field(field_name, uuids):
+def range_field(field_name, uuids, batch_size=BATCH_SIZE):
 
     # roman / other numerals ?
     increment = 0
     step = 1
     modified = []
+    indexes = {}
 
-    for i, u in enumerate(uuids):
-        redis_conn.hset(u, field_name, increment)
-        increment += step
-        modified.append(u)
+    for batch in chunked(uuids, batch_size):
+        pairs = []
+        for u in batch:
+            pairs.append((u, increment))
+            increment += step
+        write_field(field_name, pairs, indexes)
+        modified.extend(batch)
 
     return modified
 
-def remove_field(field_name, uuids):
+def remove_field(field_name, uuids, batch_size=BATCH_SIZE):
 
     modified = []
+    indexes = {}
 
-    for u in uuids:
-        redis_conn.hdel(u, *[field_name])
-        modified.append(u)
+    for batch in chunked(uuids, batch_size):
+        write_field(field_name, [(u, None) for u in batch], indexes)
+        modified.extend(batch)
 
     return modified
 
+def write_field(field_name, pairs, indexes=None):
+    """
+    set field_name for a batch of (key, value) pairs in one
+    pipeline, a value of None removes the field
+
+    any index on field_name is updated in the same pipeline,
+    indexes is a {prefix : {field : index type}} dict reused
+    across batches to avoid refetching index registries
+    """
+    if indexes is None:
+        indexes = {}
+
+    index_types = {}
+    for key, _ in pairs:
+        prefix = data_index.prefix_of(key)
+        if prefix not in indexes:
+            indexes[prefix] = data_index.indexed_fields(db.text, prefix)
+        index_types[key] = indexes[prefix].get(field_name)
+
+    # indexed values are needed to remove
+    # stale entries from string indexes
+    previous = {}
+    string_indexed = {}
+    for key, _ in pairs:
+        if index_types[key] == data_index.STRING:
+            string_indexed.setdefault(data_index.prefix_of(key), []).append(key)
+    for prefix, keys in string_indexed.items():
+        previous.update(data_index.indexed_values(db.text, prefix, field_name, keys))
+
+    pipe = db.text.pipeline(transaction=False)
+    for key, value in pairs:
+        if value is None:
+            pipe.hdel(key, field_name)
+        else:
+            pipe.hset(key, field_name, value)
+        if index_types[key]:
+            data_index.stage(pipe,
+                             data_index.prefix_of(key),
+                             field_name,
+                             index_types[key],
+                             key,
+                             previous.get(key),
+                             None if value is None else str(value))
+    pipe.execute()
+
+def index_key(key):
+    # add an existing hash to any
+    # indexes registered for its prefix
+    prefix = data_index.prefix_of(key)
+    indexes = data_index.indexed_fields(db.text, prefix)
+    if not indexes:
+        return
+    string_fields = [field for field, field_type in indexes.items() if field_type == data_index.STRING]
+    pipe = db.text.pipeline(transaction=False)
+    pipe.hmget(key, *indexes.keys())
+    for field in string_fields:
+        pipe.hget(data_index.values_key(prefix, field), key)
+    values, *previous = pipe.execute()
+    previous = dict(zip(string_fields, previous))
+
+    pipe = db.text.pipeline(transaction=False)
+    for (field, field_type), value in zip(indexes.items(), values):
+        data_index.stage(pipe, prefix, field, field_type, key, previous.get(field), value)
+    pipe.execute()
+
+def create_index(prefix, field, field_type=data_index.STRING, batch_size=BATCH_SIZE):
+    """
+    build and register an index for field on all keys
+    matching prefix, returns number of keys indexed
+    """
+    prefix = prefix.strip(":")
+    return data_index.build(db.text,
+                            prefix,
+                            field,
+                            field_type,
+                            iterate_many(iterate_data(prefix + ":*"), [field], batch_size),
+                            batch_size)
+
+def drop_index(prefix, field):
+    data_index.drop(db.text, prefix.strip(":"), field)
+
+def list_indexes(prefix):
+    return data_index.indexed_fields(db.text, prefix.strip(":"))
+
+def maintain_indexes(prefix, ttl=data_index.MAINTAINED_TTL):
+    """
+    keep indexes for prefix current with keys written by other
+    services by following keyspace notifications, runs until
+    interrupted
+
+    indexes are rebuilt on start and only used by readers while
+    this runs
+    """
+    prefix = prefix.strip(":")
+    conn = db.text
+    try:
+        events = conn.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+    except redis.exceptions.ResponseError as ex:
+        events = ""
+        print("could not check keyspace notifications: {}".format(ex))
+    # hash, generic and expired events on keyspace channels
+    if "K" not in events or not ("A" in events or all(c in events for c in "hgx")):
+        print("keyspace notifications are disabled, enable with:")
+        print("    redis-cli config set notify-keyspace-events KA")
+        return
+
+    pubsub = conn.pubsub(ignore_subscribe_messages=True)
+    channel = "__keyspace@{}__:".format(conn.connection_pool.connection_kwargs.get("db", 0))
+    pubsub.psubscribe(channel + prefix + ":*")
+
+    # changes from here on are queued on the subscription
+    # while the indexes are rebuilt
+    conn.delete(data_index.keys_key(prefix))
+    for field, field_type in data_index.indexed_fields(conn, prefix).items():
+        indexed = create_index(prefix, field, field_type)
+        print("indexed {} keys for {}:{}".format(indexed, prefix, field))
+
+    removed = ("del", "expired", "evicted", "rename_from")
+    beat = 0
+    try:
+        while True:
+            if time.time() - beat > ttl / 3:
+                data_index.heartbeat(conn, prefix, ttl)
+                beat = time.time()
+            message = pubsub.get_message(timeout=ttl / 3)
+            if message is None:
+                continue
+            key = message["channel"][len(channel):]
+            if message["data"] in removed:
+                data_index.forget(conn, prefix, key)
+            else:
+                index_key(key)
+    finally:
+        conn.delete(data_index.maintained_key(prefix))
+        pubsub.close()
+
+def index_for(pattern, field):
+    # return (prefix, index type) if field is indexed
+    # for pattern and the index is being kept current,
+    # otherwise (None, None)
+    prefix = data_index.pattern_prefix(pattern)
+    if prefix is not None:
+        field_type = data_index.indexed_fields(db.text, prefix).get(field)
+        if field_type and data_index.is_current(db.text, prefix):
+            return prefix, field_type
+    return None, None
+
+def candidates(pattern, field):
+    """
+    keys that may have field, from the index if
+    available otherwise from scanning pattern
+    """
+    prefix, field_type = index_for(pattern, field)
+    if prefix is not None:
+        return data_index.members(db.text, prefix, field, field_type)
+    return iterate_data(pattern)
+
+def latest_by(pattern, field):
+    """
+    return key with the highest value of field, uses the index
+    if available instead of sorting the keyspace
+    """
+    prefix, field_type = index_for(pattern, field)
+    if prefix is None:
+        try:
+            return sort_by(pattern, field)[-1][0]
+        except IndexError:
+            return None
+
+    while True:
+        found = data_index.last(db.text, prefix, field, field_type)
+        if found is None:
+            return None
+        key, indexed_value = found
+        pipe = db.text.pipeline(transaction=False)
+        pipe.exists(key)
+        pipe.hget(key, field)
+        exists, value = pipe.execute()
+        if data_index.is_value(field_type, indexed_value, value):
+            return key
+        # stale entry, ie an expired duplicate or a value
+        # changed before the maintainer caught up
+        if not exists:
+            data_index.forget(db.text, prefix, key)
+        data_index.discard(db.text, prefix, field, field_type, key, indexed_value)
+        if exists:
+            index_key(key)
+
+def random_key(pattern, attempts=5):
+    """
+    return a random key matching pattern, from the
+    index key set if pattern has indexes
+    """
+    prefix = data_index.pattern_prefix(pattern)
+    if (prefix is not None and
+        data_index.indexed_fields(db.text, prefix) and
+        data_index.is_current(db.text, prefix)):
+        for _ in range(attempts):
+            key = data_index.random_key(db.text, prefix)
+            if key is None:
+                break
+            if db.text.exists(key):
+                return key
+            data_index.forget(db.text, prefix, key)
+
+    return random.choice(enumerate_data(pattern=pattern))
+
+def chunked(iterable, size):
+    """
+    yield lists of at most size items from iterable
+    without materializing the whole iterable
+    """
+    size = max(1, int(size))
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 def filter_data(filter_key,pattern):
 
-    data = enumerate_data(pattern=pattern)
     data_filtered = []
-    for d in data:
-        has_key = redis_conn.hget(d, filter_key)
+    for d, fields in iterate_many(candidates(pattern, filter_key), [filter_key]):
+        has_key = fields.get(filter_key)
         if has_key:
             data_filtered.append((d, has_key))
     data_filtered = sorted(data_filtered, key=lambda x: x[1])
@@ -104,12 +373,17 @@ def filter_data(filter_key,pattern):
 
 def filter_data_to_dict(filter_key,pattern,subsort=None,whitelist=None):
 
-    data = enumerate_data(pattern=pattern)
     data_filtered = {}
     whitelist_passes = None
 
-    for d in data:
-        has_key = redis_conn.hget(d, filter_key)
+    fields_needed = [filter_key]
+    if whitelist:
+        fields_needed.extend(whitelist.keys())
+    if subsort:
+        fields_needed.append(subsort)
+
+    for d, fields in iterate_many(candidates(pattern, filter_key), fields_needed):
+        has_key = fields.get(filter_key)
         if has_key:
             if not has_key in data_filtered:
                 data_filtered[has_key] = []
@@ -117,7 +391,7 @@ def filter_data_to_dict(filter_key,pattern,subsort=None,whitelist=None):
             if whitelist:
                 check = []
                 for k,v in whitelist.items():
-                    value = redis_conn.hget(d, k)
+                    value = fields.get(k)
                     if value in v and value is not None:
                         check.append(True)
                     elif value not in v and value is not None:
@@ -130,12 +404,8 @@ def filter_data_to_dict(filter_key,pattern,subsort=None,whitelist=None):
                 else:
                     whitelist_passes = False
 
-            if subsort and whitelist_passes is True or whitelist_passes is None:
-                data_filtered[has_key].append((d,redis_conn.hget(d, subsort)))
-            elif not subsort and whitelist_passes is True or whitelist_passes is None:
-                data_filtered[has_key].append(d)
-            else:
-                pass
+            if whitelist_passes is True or whitelist_passes is None:
+                data_filtered[has_key].append((d, fields.get(subsort) if subsort else None))
 
     if subsort:
         for key in data_filtered.keys():
@@ -155,48 +425,253 @@ def enumerate_data(pattern):
 
     # terminal equivalent $ redis-cli -h {ip} -p {port} keys {pattern}
 
-    # for key in redis_conn.scan_iter(match=pattern):
+    # for key in db.text.scan_iter(match=pattern):
     #     print(key)
 
-    return list(redis_conn.scan_iter(match=pattern))
+    return list(iterate_data(pattern))
+
+def iterate_data(pattern, count=SCAN_COUNT, key_type=None, cursor=0):
+    # stream matching keys as scan returns them
+    # instead of waiting for the whole keyspace
+    for _, _, keys in scan_pages(pattern, count, key_type, cursor):
+        yield from keys
+
+def scan_pages(pattern, count=SCAN_COUNT, key_type=None, cursor=0):
+    """
+    yield (cursor, next cursor, keys) for each SCAN call
+
+    key_type ie 'hash' is filtered server-side, falling
+    back to pipelined TYPE calls for redis < 6.0
+    """
+    server_side_type = key_type is not None
+    while True:
+        try:
+            if server_side_type:
+                next_cursor, keys = db.text.scan(cursor, match=pattern, count=count, _type=key_type)
+            else:
+                next_cursor, keys = db.text.scan(cursor, match=pattern, count=count)
+        except redis.exceptions.ResponseError:
+            if not server_side_type:
+                raise
+            server_side_type = False
+            continue
+
+        if key_type is not None and not server_side_type and keys:
+            pipe = db.text.pipeline(transaction=False)
+            for key in keys:
+                pipe.type(key)
+            keys = [k for k, t in zip(keys, pipe.execute()) if t == key_type]
+
+        yield cursor, next_cursor, keys
+        cursor = next_cursor
+        if int(cursor) == 0:
+            break
+
+def sorted_stream(iterable, chunk_size=SORT_CHUNK_SIZE):
+    """
+    yield strings from iterable in sorted order holding at most
+    chunk_size of them in memory, larger inputs are written to
+    temporary files as sorted runs and merged
+
+    strings are stored one per line so must not contain newlines
+    """
+    runs = []
+    try:
+        for chunk in chunked(iterable, chunk_size):
+            chunk.sort()
+            if len(chunk) < chunk_size and not runs:
+                # everything fit in memory
+                yield from chunk
+                return
+            run = tempfile.TemporaryFile(mode="w+")
+            run.writelines(item + "\n" for item in chunk)
+            run.seek(0)
+            runs.append(run)
+
+        for line in heapq.merge(*runs):
+            yield line[:-1]
+    finally:
+        for run in runs:
+            run.close()
 
 def sort_by(pattern, field):
 
     field_values = []
-    for key in redis_conn.scan_iter(match=pattern):
-        try:
-            value = redis_conn.hget(key, field)
-            if value:
-                field_values.append((key, value))
-        except redis.exceptions.ResponseError as ex:
-            print(ex)
+    for key, fields in iterate_many(candidates(pattern, field), [field]):
+        value = fields.get(field)
+        if value:
+            field_values.append((key, value))
 
     return sorted(field_values, key=lambda x: x[1])
 
 def service_connection():
 
-    return (r_ip, r_port)
+    return db.address()
 
-def open_img(address_uuid, key=None):
-    if key is not None:
-        bytes_key = redis_conn.hget(address_uuid, key)
-    else:
-        bytes_key = address_uuid
+def open_img(address_uuid, key=None, max_size=None):
+    image = load_image(binary_key(address_uuid, key), max_size)
+    # image is fully decoded so the file is only
+    # returned for callers expecting (image, file)
+    return image, io.BytesIO()
 
-    key_bytes = binary_redis_conn.get(bytes_key)
-    file = io.BytesIO()
-    file.write(key_bytes)
+def binary_key(address_uuid, key=None):
+    if key is not None:
+        return db.text.hget(address_uuid, key)
+    return address_uuid
+
+def load_image(bytes_key, max_size=None):
+    """
+    return a decoded image for the binary stored at bytes_key
+
+    images are served from image_cache while the blob's
+    fingerprint is unchanged, the returned image is a
+    private copy and can be modified freely
+
+    max_size (width, height) decodes a reduced preview
+    that fits within max_size, see decode_image
+    """
+    pipe = db.binary.pipeline(transaction=False)
+    pipe.strlen(bytes_key)
+    pipe.getrange(bytes_key, 0, FINGERPRINT_BYTES - 1)
+    pipe.getrange(bytes_key, -FINGERPRINT_BYTES, -1)
+    key_fingerprint = image_cache.fingerprint(*pipe.execute())
+
+    cache_key = preview_key(bytes_key, max_size)
+    image = decoded_images.get(cache_key, key_fingerprint)
+    if image is not None:
+        return image
+
+    key_bytes = db.binary.get(bytes_key)
+    if key_bytes is None:
+        raise KeyError("no binary for key: {}".format(bytes_key))
+
+    return decoded_images.put(cache_key, key_fingerprint, decode_image(key_bytes, max_size))
+
+def preview_key(bytes_key, max_size=None):
+    # reduced decodes are cached separately
+    # from full resolution ones
+    if max_size is None:
+        return bytes_key
+    return "{}@{}x{}".format(bytes_key, *max_size)
+
+def decode_image(key_bytes, max_size=None):
+    """
+    decode bytes into a loaded image without copying them
+
+    if max_size is given, jpegs are decoded at a reduced scale
+    using DCT scaling (draft mode) and the result is resized
+    to fit within max_size
+    """
+    # BytesIO shares an immutable bytes object
+    # instead of copying it until written to
+    file = io.BytesIO(key_bytes)
+    from PIL import Image
     image = Image.open(file)
-    #file.close()
-    # file does not get closed
-    return image, file
-    # yield image
-    # file = io.BytesIO()
-    # #image.save(file,image.format)
-    # image.close()
-    # file.seek(0)
-    # #binary_r.set(bytes_key, file.read())
-    # file.close()
+    # kept so drawing on previews can be
+    # scaled to full resolution coordinates
+    original_size = image.size
+    if max_size is not None:
+        max_size = (int(max_size[0]), int(max_size[1]))
+        # only has an effect for jpeg, picks the largest
+        # scale reduction still at least max_size
+        image.draft(image.mode, max_size)
+    image.load()
+    if max_size is not None:
+        image.thumbnail(max_size)
+    image.info["original_size"] = original_size
+    # decoded pixels are kept, the file is not needed
+    file.close()
+    return image
+
+def load_images(bytes_keys, max_size=None, workers=DECODE_WORKERS, transform=None, transforms=None):
+    """
+    yield decoded images for bytes_keys in order, or None for
+    keys that are missing or are not images
+
+    fingerprints and blobs are fetched with pipelined round
+    trips and decoded on a pool of workers threads, each image
+    is yielded as soon as it and the ones before it are ready.
+    At most 2 * workers images are fetched ahead of the caller
+
+    transform(image, transforms[i]) is run on the worker
+    thread after decoding, ie for per-image modifications
+    """
+    bytes_keys = list(bytes_keys)
+    if transforms is None:
+        transforms = [None] * len(bytes_keys)
+
+    def apply(image, extra):
+        if transform is not None:
+            return transform(image, extra)
+        return image
+
+    def decode(bytes_key, key_fingerprint, key_bytes, extra):
+        try:
+            image = decode_image(key_bytes, max_size)
+        except Exception as ex:
+            print("could not decode {}: {}".format(bytes_key, ex))
+            return None
+        image = decoded_images.put(preview_key(bytes_key, max_size), key_fingerprint, image)
+        return apply(image, extra)
+
+    pipe = db.binary.pipeline(transaction=False)
+    for bytes_key in bytes_keys:
+        pipe.strlen(bytes_key)
+        pipe.getrange(bytes_key, 0, FINGERPRINT_BYTES - 1)
+        pipe.getrange(bytes_key, -FINGERPRINT_BYTES, -1)
+    results = pipe.execute(raise_on_error=False)
+
+    workers = max(1, workers)
+    # images fetched or decoding but not yet yielded, blobs
+    # are only fetched while fewer than this are in flight
+    max_in_flight = 2 * workers
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        # fetch in chunks so decoding starts
+        # while later blobs are transferred
+        for batch in chunked(range(len(bytes_keys)), workers):
+            while len(pending) > max_in_flight - len(batch):
+                future = pending.popleft()
+                yield future.result() if future is not None else None
+
+            submitted = {}
+            misses = []
+            for i in batch:
+                bytes_key = bytes_keys[i]
+                fingerprint_parts = results[i * 3:i * 3 + 3]
+                if any(isinstance(r, Exception) for r in fingerprint_parts) or not fingerprint_parts[0]:
+                    # wrong type or missing
+                    submitted[i] = None
+                    continue
+                key_fingerprint = image_cache.fingerprint(*fingerprint_parts)
+                image = decoded_images.get(preview_key(bytes_key, max_size), key_fingerprint)
+                if image is not None:
+                    submitted[i] = executor.submit(apply, image, transforms[i])
+                else:
+                    misses.append((i, bytes_key, key_fingerprint))
+
+            if misses:
+                pipe = db.binary.pipeline(transaction=False)
+                for _, bytes_key, _ in misses:
+                    pipe.get(bytes_key)
+                for (i, bytes_key, key_fingerprint), key_bytes in zip(misses, pipe.execute(raise_on_error=False)):
+                    if isinstance(key_bytes, bytes):
+                        submitted[i] = executor.submit(decode, bytes_key, key_fingerprint, key_bytes, transforms[i])
+                    else:
+                        submitted[i] = None
+            pending.extend(submitted[i] for i in batch)
+
+            # hand back images that are already done
+            while pending and (pending[0] is None or pending[0].done()):
+                future = pending.popleft()
+                yield future.result() if future is not None else None
+
+        while pending:
+            future = pending.popleft()
+            yield future.result() if future is not None else None
+
+def image_cache_stats():
+    return decoded_images.stats()
 
 def close_img(img):
     try:
@@ -235,29 +710,17 @@ def img_rectangle_grid(
     upper_left_square = int(upper_left_square)
     lower_right_square = int(lower_right_square)
 
-    imgw, imgh = img.size
-
-    grid_number = 0
-    x, y, x2, y2 = 0, 0, 0, 0
-    for col in range(0, imgw, xspacing):
-        for row in range(0, imgh, yspacing):
-            if grid_number == upper_left_square:
-                x = col
-                y = row
-
-            if grid_number == lower_right_square:
-                x2 = col + xspacing
-                y2 = row + yspacing
-
-            grid_number += 1
-
-    print(x, y, x2 - x, y2 - y)
-    img = img_rectangle(img, x, y, x2 - x, y2 - y)
+    x, y, w, h = geometry.grid_rectangle(img.size,
+                                         xspacing,
+                                         yspacing,
+                                         upper_left_square,
+                                         lower_right_square)
+    print(x, y, w, h)
 
     if geometry_only is True:
-        return (x, y, x2 - x, y2 - y)
+        return (x, y, w, h)
     else:
-        return img
+        return img_rectangle(img, x, y, w, h)
 
 def img_grid(
         img,
@@ -274,31 +737,8 @@ def img_grid(
     g = int(g)
     b = int(b)
     a = int(a)
-    draw = ImageDraw.Draw(img)
-    imgw, imgh = img.size
-
-    for col in range(0, imgw, xspacing):
-        draw.line((col, 0, col, imgh), fill=(r, g, b))
 
-    for row in range(0, imgh, yspacing):
-        draw.line((0, row, imgw, row), fill=(r, g, b))
-
-    if label:
-        grid_number = 0
-        for col in range(0, imgw, xspacing):
-            for row in range(0, imgh, yspacing):
-                draw.text((col, row), str("({}, {})".format(col, row)), (255, 255, 255))
-                grid_label = str("{}".format(grid_number))
-                w, h = draw.textsize(grid_label)
-                tx = int(round(col + (xspacing / 2) - (w / 2)))
-                ty = int(round(row + (yspacing / 2) - (h / 2)))
-                # print(tx,ty)
-                # #draw.text(tx, ty, grid_label, (255,255,255))
-                draw.text((tx, ty), grid_label, (255, 255, 255))
-                grid_number += 1
-
-    #del draw
-    return img
+    return stamp_grid(img, "grid", xspacing, yspacing, (r, g, b), label)
 
 def img_geometry_rectangle_column(
         img,
@@ -322,28 +762,16 @@ def img_rectangle_column(
     left_column = int(left_column)
     right_column = int(right_column)
 
-    imgw, imgh = img.size
-
-    column_number = 0
-    x, y, x2, y2 = 0, 0, 0, 0
-    for col in range(0, imgw, xspacing):
-        if column_number == left_column:
-            x = col
-            y = 0
-
-        if column_number == right_column:
-            x2 = col + xspacing
-            y2 = imgh
-
-        column_number += 1
-
-    print(x, y, x2 - x, y2 - y)
-    img = img_rectangle(img, x, y, x2 - x, y2 - y)
+    x, y, w, h = geometry.column_rectangle(img.size,
+                                           xspacing,
+                                           left_column,
+                                           right_column)
+    print(x, y, w, h)
 
     if geometry_only is True:
-        return (x, y, x2 - x, y2 - y)
+        return (x, y, w, h)
     else:
-        return img
+        return img_rectangle(img, x, y, w, h)
 
 def img_column(
         img,
@@ -358,24 +786,8 @@ def img_column(
     g = int(g)
     b = int(b)
     a = int(a)
-    draw = ImageDraw.Draw(img)
-    imgw, imgh = img.size
-
-    for col in range(0, imgw, xspacing):
-        draw.line((col, 0, col, imgh), fill=(r, g, b))
-
-    if label:
-        column_number = 0
-        for col in range(0, imgw, xspacing):
-            draw.text((col, 0), str("({}, {})".format(col, 0)), (255, 255, 255))
-            column_label = str("{}".format(column_number))
-            w, h = draw.textsize(column_label)
-            tx = int(round(col + (xspacing / 2) - (w / 2)))
-            ty = int(round((imgh / 2)))
-            draw.text((tx, ty), column_label, (255, 255, 255))
-            column_number += 1
 
-    return img
+    return stamp_grid(img, "column", xspacing, None, (r, g, b), label)
 
 def img_geometry_rectangle_row(
         img,
@@ -399,28 +811,16 @@ def img_rectangle_row(
     upper_row = int(upper_row)
     lower_row = int(lower_row)
 
-    imgw, imgh = img.size
-
-    row_number = 0
-    x, y, x2, y2 = 0, 0, 0, 0
-    for row in range(0, imgh, yspacing):
-        if row_number == upper_row:
-            x = 0
-            y = row
-
-        if row_number == lower_row:
-            x2 = imgw
-            y2 = row + yspacing
-
-        row_number += 1
-
-    print(x, y, x2 - x, y2 - y)
-    img = img_rectangle(img, x, y, x2 - x, y2 - y)
+    x, y, w, h = geometry.row_rectangle(img.size,
+                                        yspacing,
+                                        upper_row,
+                                        lower_row)
+    print(x, y, w, h)
 
     if geometry_only is True:
-        return (x, y, x2 - x, y2 - y)
+        return (x, y, w, h)
     else:
-        return img
+        return img_rectangle(img, x, y, w, h)
 
 def img_row(
         img,
@@ -435,25 +835,101 @@ def img_row(
     g = int(g)
     b = int(b)
     a = int(a)
-    draw = ImageDraw.Draw(img)
+
+    return stamp_grid(img, "row", None, yspacing, (r, g, b), label)
+
+def stamp_grid(img, kind, xspacing, yspacing, color, label=True):
+    """
+    draw grid, column or row lines and labels onto img in place
+
+    lines are filled directly as 1px boxes and each label is
+    rendered once into a small mask (see label_mask) that is
+    stamped wherever the label appears, so no full frame
+    masks are drawn or kept
+    """
     imgw, imgh = img.size
+    columns = range(0, imgw, xspacing) if kind in ("grid", "column") else []
+    rows = range(0, imgh, yspacing) if kind in ("grid", "row") else []
 
-    for row in range(0, imgh, yspacing):
-        draw.line((0, row, imgw, row), fill=(r, g, b))
+    line_ink = ink(img, color)
+    # a line is a 1px wide filled box
+    for col in columns:
+        img.paste(line_ink, (col, 0, col + 1, imgh))
+    for row in rows:
+        img.paste(line_ink, (0, row, imgw, row + 1))
+
+    if not label:
+        return img
 
-    if label:
-        row_number = 0
-        for row in range(0, imgh, yspacing):
-            draw.text((0, row), str("({}, {})".format(0, row)), (255, 255, 255))
-            row_label = str("{}".format(row_number))
-            w, h = draw.textsize(row_label)
-            tx = int(round(imgw / 2))
-            ty = int(round(row + (yspacing / 2) - (h / 2)))
-            draw.text((tx, ty), row_label, (255, 255, 255))
-            row_number += 1
+    label_ink = ink(img, (255, 255, 255))
+
+    def stamp(text, x, y):
+        mask = label_mask(text)
+        img.paste(label_ink, (x, y, x + mask.size[0], y + mask.size[1]), mask)
+
+    if kind == "grid":
+        grid_number = 0
+        for col in columns:
+            for row in rows:
+                stamp("({}, {})".format(col, row), col, row)
+                w, h = label_size(str(grid_number))
+                stamp(str(grid_number),
+                      int(round(col + (xspacing / 2) - (w / 2))),
+                      int(round(row + (yspacing / 2) - (h / 2))))
+                grid_number += 1
+    elif kind == "column":
+        for column_number, col in enumerate(columns):
+            stamp("({}, {})".format(col, 0), col, 0)
+            w, h = label_size(str(column_number))
+            stamp(str(column_number),
+                  int(round(col + (xspacing / 2) - (w / 2))),
+                  int(round((imgh / 2))))
+    elif kind == "row":
+        for row_number, row in enumerate(rows):
+            stamp("({}, {})".format(0, row), 0, row)
+            w, h = label_size(str(row_number))
+            stamp(str(row_number),
+                  int(round(imgw / 2)),
+                  int(round(row + (yspacing / 2) - (h / 2))))
 
     return img
 
+def ink(img, color):
+    from PIL import ImageColor
+    return ImageColor.getcolor("rgb({}, {}, {})".format(*color), img.mode)
+
+def label_mask(text, fontsize=None):
+    """
+    return an "L" mask of text drawn with the default font,
+    masks are cached by text and font size within the
+    grid_labels budget
+    """
+    mask = grid_labels.get(text, str(fontsize))
+    if mask is not None:
+        return mask
+    from PIL import Image, ImageDraw
+    w, h = label_size(text)
+    mask = Image.new("L", (max(1, w), max(1, h)), 0)
+    ImageDraw.Draw(mask).text((0, 0), text, 255, font=default_font())
+    return grid_labels.put(text, str(fontsize), mask)
+
+@lru_cache(maxsize=4096)
+def label_size(text):
+    return text_size(text, default_font())
+
+def text_size(text, font):
+    # textsize was removed in newer versions of pillow
+    try:
+        left, top, right, bottom = font.getbbox(text)
+        return right, bottom
+    except AttributeError:
+        return font.getsize(text)
+
+@lru_cache(maxsize=1)
+def default_font():
+    from PIL import ImageFont
+    return ImageFont.load_default()
+
 def img_geometry_rectangle(
         img, x, y, w, h,
         r=255,
@@ -475,119 +951,233 @@ def img_rectangle(
     y = int(y)
     w = int(w)
     h = int(h)
-    r = int(r)
-    g = int(g)
-    b = int(b)
-    a = int(a)
 
-    img = img.convert("RGBA")
-    overlay = Image.new('RGBA', img.size, (0, 0, 0, 0))
-    draw = ImageDraw.Draw(overlay)
-    draw.rectangle((x, y, x + w, y + h), (r, g, b, a))
-    img = Image.alpha_composite(img, overlay)
-    # return img otherwise composite is not visible
     if geometry_only is True:
         return (x, y, x + w, y + h)
-    else:
-        return img
+    # return img otherwise composite is not visible
+    return Compositor().rectangle(x, y, w, h, r, g, b, a).render(img)
 
 def img_overlay(img, text, x, y, fontsize, substitutions=None, **kwargs):
-    if substitutions is None:
-        substitutions = {}
-    x = int(x)
-    y = int(y)
-    fontsize = int(fontsize)
+    return Compositor(substitutions).text(text, x, y, fontsize).render(img)
+
+def img_layers(img, *layers, substitutions=None, **kwargs):
+    """
+    draw layers such as 'rectangle 10 10 100 100 255 255 255 50'
+    or 'overlay foo 10 10 30' in a single composite
+
+    from the image cli layers are separated by ';'
+    ie layers rectangle 1 1 20 20 ; overlay foo 1 1 20
+    """
+    if layers and not any(" " in str(layer) for layer in layers):
+        layers = " ".join(str(layer) for layer in layers).split(";")
+
+    compositor = Compositor(substitutions)
+    for layer in layers:
+        layer = str(layer).strip().split(" ")
+        layer_func, layer_args = layer[0], layer[1:]
+        if not layer_func:
+            continue
+        try:
+            if not compositor.add(layer_func, *layer_args):
+                # not a drawing layer, composite what has
+                # been collected and apply it directly
+                img = compositor.render(img)
+                compositor = Compositor(substitutions)
+                img = globals()['img_' + layer_func](img, *layer_args)
+        except Exception as ex:
+            print(ex)
 
-    text = text.format_map(Default(substitutions))
-    draw = ImageDraw.Draw(img)
-    try:
-        font = ImageFont.truetype("DejaVuSansMono.ttf", fontsize)
-        draw.text((x, y), text, (255, 255, 255), font=font)
-    except:
-        font = ImageFont.truetype("/usr/share/fonts/truetype/freefont/DejaVuSansMono.ttf", fontsize)
-        draw.text((x, y), text, (255, 255, 255), font=font)
+    return compositor.render(img)
+
+class Compositor(object):
+    """Collect rectangle and text drawing operations and
+    composite them onto an image in one pass
+
+    rectangles are alpha blended in order directly into an
+    rgb copy of the image, images with an alpha channel have
+    each rectangle composited in order as a tile covering only
+    the rectangle, so overlapping rectangles stack the same way
+    """
+    def __init__(self, substitutions=None):
+        if substitutions is None:
+            substitutions = {}
+        self.substitutions = substitutions
+        self.ops = []
+
+    def rectangle(self, x, y, w, h, r=255, g=255, b=255, a=127):
+        x, y, w, h = int(x), int(y), int(w), int(h)
+        self.ops.append(("rectangle",
+                         (x, y, x + w, y + h),
+                         (int(r), int(g), int(b), int(a))))
+        return self
+
+    def text(self, text, x, y, fontsize, fill=(255, 255, 255)):
+        text = str(text).format_map(Default(self.substitutions))
+        self.ops.append(("text", (int(x), int(y)), text, int(fontsize), fill))
+        return self
+
+    def add(self, layer_func, *layer_args):
+        """
+        add a layer by name, returns False for
+        layers that are not drawing operations
+        """
+        if layer_func == "rectangle":
+            self.rectangle(*layer_args)
+        elif layer_func == "overlay":
+            self.text(*layer_args)
+        else:
+            return False
+        return True
+
+    def render(self, img):
+        from PIL import Image, ImageDraw
+        if not self.ops:
+            return img
+
+        if not any(op[0] == "rectangle" for op in self.ops):
+            # text is opaque so can be drawn in place
+            self._draw(ImageDraw.Draw(img))
+        elif "A" in img.getbands():
+            img = img.convert("RGBA")
+            draw = ImageDraw.Draw(img)
+            for op in self.ops:
+                if op[0] == "rectangle":
+                    self._composite(img, *op[1:])
+                else:
+                    self._draw(draw, [op])
+        else:
+            # drawing with an rgba ink blends onto rgb images
+            img = img.convert("RGB")
+            self._draw(ImageDraw.Draw(img, "RGBA"))
 
-    return img
+        self.ops = []
+        return img
+
+    def _composite(self, img, box, color):
+        from PIL import Image
+        # rectangles include their right and bottom edges
+        x0, x1 = sorted((box[0], box[2]))
+        y0, y1 = sorted((box[1], box[3]))
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1 + 1, img.size[0]), min(y1 + 1, img.size[1])
+        if x1 > x0 and y1 > y0:
+            img.alpha_composite(Image.new("RGBA", (x1 - x0, y1 - y0), color), (x0, y0))
+
+    def _draw(self, draw, ops=None):
+        for op in (self.ops if ops is None else ops):
+            if op[0] == "rectangle":
+                _, box, color = op
+                draw.rectangle(box, color)
+            else:
+                _, position, text, fontsize, fill = op
+                draw.text(position, text, fill, font=load_font(fontsize))
+
+@lru_cache(maxsize=64)
+def load_font(fontsize, font_paths=FONT_PATHS):
+    from PIL import ImageFont
+    # parsed fonts are cached by (paths, size)
+    for font_path in font_paths:
+        try:
+            return ImageFont.truetype(font_path, fontsize)
+        except OSError:
+            pass
+    return default_font()
 
 def img_view(img):
-    img.show()
+    show(img)
     return img
 
-def view_concatenate(uuids, modifications):
-
-    images = []
+def view_concatenate(uuids,
+                     modifications,
+                     max_size=None,
+                     workers=DECODE_WORKERS,
+                     output_dir=None,
+                     max_canvas=montage.MAX_CANVAS,
+                     columns=None):
 
-    for thing in uuids:
-        fields = redis_conn.hgetall(thing)
+    sources = []
+    for thing, fields in iterate_many(uuids):
         for k, v in fields.items():
             if ":" in v or "binary:" in v or "glworb_binary:" in v or "_key" in k:
-                try:
-                    # append (pil image, file object, fields)
-                    images.append((*open_img(thing, key=k), fields))
-                except Exception as ex:
-                    pass
+                sources.append((v, fields))
 
-    border = 50
-    landscape_width = sum([img.size[0] + border for img, _, _ in images])
-    landscape_height = max([img.size[1] for img, _, _ in images])
-    landscape = Image.new('RGBA', (landscape_width, landscape_height))
+    if not sources:
+        return []
 
-    offset = 0
-
-    for img, file, fields in images:
+    def prepare(img, fields):
         for m in modifications:
             m = m.split(" ")
             try:
                 img = globals()[m[0]](img, *m[1:])
             except Exception as ex:
                 print(ex)
-        img = img_overlay(img, pretty_format(fields), 100, 100, 30)
-        landscape.paste(img, (offset, 0))
-        offset += img.size[0] + border
-
-    landscape.show()
-
-    # cleanup
-    for img, file, _ in images:
-        img.close()
-        file.close()
+        # placed as on the full resolution image
+        # when img is a reduced preview
+        scale = img.size[0] / img.info.get("original_size", img.size)[0]
+        return img_overlay(img,
+                           pretty_format(fields),
+                           int(round(100 * scale)),
+                           int(round(100 * scale)),
+                           max(1, int(round(30 * scale))))
+
+    def show_page(page):
+        show(page)
+        page.close()
+
+    # pages are shown as soon as they are
+    # finished unless written to output_dir
+    grid = montage.Montage(len(sources),
+                           max_canvas=max_canvas,
+                           columns=columns,
+                           output_dir=output_dir,
+                           on_page=show_page if output_dir is None else None)
+
+    # without modifications (which use full resolution
+    # coordinates) decode straight to the cell size
+    if max_size is None and not modifications:
+        max_size = grid.cell_size
+
+    # tiles are modified and overlaid on the decode
+    # threads and pasted as soon as each image is ready
+    for img in load_images([bytes_key for bytes_key, _ in sources],
+                           max_size=max_size,
+                           workers=workers,
+                           transforms=[fields for _, fields in sources],
+                           transform=prepare):
+        if img is not None:
+            grid.add(img)
+            img.close()
+
+    pages = grid.finish()
+    for page in pages:
+        print(page)
+    return pages
 
 def view(thing_uuid, field=None, overlay="", prefix="", layers=None, output=None):
     env = {}
     try:
-        env['substitutions'] = redis_conn.hgetall(thing_uuid)
+        env['substitutions'] = db.text.hgetall(thing_uuid)
     except:
         env['substitutions'] = {}
 
-    layers = ["rectangle 10 10 100 100 255 255 255 50",
-              "overlay foo 10 10 30"
-             ]
+    if layers is None:
+        layers = ["rectangle 10 10 100 100 255 255 255 50",
+                  "overlay foo 10 10 30"
+                 ]
     if field is not None:
-        field_contents = redis_conn.hget(prefix + thing_uuid, field)
+        field_contents = db.text.hget(prefix + thing_uuid, field)
         with open_image(prefix + thing_uuid, field) as img:
-            img = img_overlay(img, field_contents, 1, 1, 20)
-            img = img_overlay(img, overlay, 1, 100, 20)
-            img.show()
+            img = Compositor().text(field_contents, 1, 1, 20).text(overlay, 1, 100, 20).render(img)
+            show(img)
             if output is not None:
                 img.save(output, img.format)
         #return { field : field_contents }
     else:
         with open_image(thing_uuid) as img:
-            img_overlay(img, overlay, 1, 100, 20)
-            for layer in layers:
-                layer_func = layer.split(" ")[0]
-                try:
-                    layer_args = layer.split(" ")[1:]
-                except:
-                    layer_args = []
-
-                try:
-                    img = globals()['img_' + layer_func](img, *layer_args, **env)
-                except Exception as ex:
-                    print(ex)
-
-            img.show()
-
+            # text alone is drawn in place without a composite
+            img = Compositor().text(overlay, 1, 100, 20).render(img)
+            img = img_layers(img, *layers, **env)
+            show(img)
 
 def pretty_format(dictionary, title="", terminal_colors=False):
 
@@ -604,34 +1194,163 @@ def pretty_format(dictionary, title="", terminal_colors=False):
 
     return pretty_string
 
-def duplicate(thing_uuid, ttl=600):
+def is_reference(field, value):
+    # need better or more consistent
+    # method for discovering referenced
+    # keys
+    return "key" in field and ":" in value
+
+def reference_graph(thing_uuid):
+    """
+    walk keys referenced from thing_uuid breadth first, one
+    pipeline per level, returns {key : fields} in visit order
+    where fields is None for keys that are not hashes
+
+    keys are visited once so cycles terminate and missing
+    keys are left out
+    """
+    graph = {}
+    visited = set([thing_uuid])
+    frontier = [thing_uuid]
+    while frontier:
+        pipe = db.text.pipeline(transaction=False)
+        for key in frontier:
+            pipe.type(key)
+            pipe.hgetall(key)
+        results = pipe.execute(raise_on_error=False)
+        next_frontier = []
+        for key, key_type, fields in zip(frontier, results[0::2], results[1::2]):
+            if key_type == "none":
+                continue
+            if key_type != "hash":
+                graph[key] = None
+                continue
+            graph[key] = fields
+            for field, value in fields.items():
+                if is_reference(field, value) and value not in visited:
+                    visited.add(value)
+                    next_frontier.append(value)
+        frontier = next_frontier
+    return graph
+
+def duplicate(thing_uuid, ttl=600, server_side=False):
+    """
+    copy thing_uuid and every key it references with
+    an expiry of ttl seconds, returns the new uuid
+
+    reference fields in copied hashes are rewritten to
+    point at the copies so they can be modified by pipes.
+    server_side uses COPY (redis >= 6.2) instead of
+    DUMP / RESTORE so values never leave the server
+
+    references to keys that could not be copied are left
+    pointing at the originals, raises if thing_uuid itself
+    could not be copied
+    """
+    graph = reference_graph(thing_uuid)
+    if thing_uuid not in graph:
+        raise KeyError("no such key: {}".format(thing_uuid))
+
+    copies = {}
+    for key in graph:
+        copies[key] = "{}:{}".format(key.split(":")[0], str(uuid.uuid4()))
 
-    # update uuid field?
     # restore ttl is milliseconds
     ttl *= 1000
-    serialized = binary_redis_conn.dump(thing_uuid)
-    prefix = thing_uuid.split(":")[0]
-    new_uuid = "{}:{}".format(prefix, str(uuid.uuid4()))
-    redis_conn.restore(new_uuid, ttl, serialized)
-
-    try:
-        hashes = redis_conn.hgetall(new_uuid)
-        # update referenced binaries
-        # so they can be modified by
-        # pipes
-        for k, v in hashes.items():
-            # need better or more consistent
-            # method for discovering referenced
-            # keys
-            if "key" in k and ":" in v:
-                hashes[k] = duplicate(v)
-                print("updating reference hash: {} to {}".format(v, hashes[k]))
-    except Exception as ex:
-        print(ex)
-
+    pipe = db.binary.pipeline(transaction=False)
+    if server_side:
+        for key, new_key in copies.items():
+            pipe.copy(key, new_key)
+            pipe.pexpire(new_key, ttl)
+        copied = pipe.execute(raise_on_error=False)[0::2]
+    else:
+        dumps = db.binary.pipeline(transaction=False)
+        for key in copies:
+            dumps.dump(key)
+        restored = []
+        for (key, new_key), serialized in zip(copies.items(), dumps.execute()):
+            if serialized is None:
+                # removed since the walk
+                continue
+            pipe.restore(new_key, ttl, serialized)
+            restored.append(key)
+        results = dict(zip(restored, pipe.execute(raise_on_error=False)))
+        copied = [results.get(key, False) for key in copies]
+
+    # references and indexes are only updated for
+    # keys that were copied
+    for key, result in zip(list(copies), copied):
+        if isinstance(result, Exception) or not result:
+            if isinstance(result, Exception):
+                print(result)
+            del copies[key]
+
+    if thing_uuid not in copies:
+        if copies:
+            db.binary.delete(*copies.values())
+        failed = copied[0]
+        if isinstance(failed, Exception):
+            raise failed
+        raise KeyError("could not copy: {}".format(thing_uuid))
+
+    pipe = db.binary.pipeline(transaction=False)
+    indexes = {}
+    for key, fields in graph.items():
+        if fields is None or key not in copies:
+            continue
+        new_key = copies[key]
+        updated = {}
+        for field, value in fields.items():
+            if is_reference(field, value) and value in copies:
+                updated[field] = copies[value]
+                print("updating reference hash: {} to {}".format(value, copies[value]))
+        if updated:
+            pipe.hset(new_key, mapping=updated)
+            fields = dict(fields, **updated)
+
+        prefix = data_index.prefix_of(new_key)
+        if prefix not in indexes:
+            indexes[prefix] = data_index.indexed_fields(db.text, prefix)
+        for field, field_type in indexes[prefix].items():
+            data_index.stage(pipe, prefix, field, field_type, new_key, None, fields.get(field))
+
+    for result in pipe.execute(raise_on_error=False):
+        if isinstance(result, Exception):
+            print(result)
+
+    new_uuid = copies[thing_uuid]
     print("duplicate: {}".format(new_uuid))
     return new_uuid
 
 def retrieve(thing_uuid, prefix=""):
 
-    return redis_conn.hgetall(prefix + thing_uuid)
+    return db.text.hgetall(prefix + thing_uuid)
+
+def retrieve_many(keys, fields=None, batch_size=BATCH_SIZE):
+    """
+    return {key : {field : value}} for keys using pipelined
+    HMGET (if fields are specified) or HGETALL in batches
+
+    fields without values are omitted and keys that are
+    not hashes are skipped
+    """
+    return dict(iterate_many(keys, fields, batch_size))
+
+def iterate_many(keys, fields=None, batch_size=BATCH_SIZE):
+    # yield (key, {field : value}) one batch
+    # at a time, keys may be a generator
+    for batch in chunked(keys, batch_size):
+        pipe = db.text.pipeline(transaction=False)
+        for key in batch:
+            if fields:
+                pipe.hmget(key, *fields)
+            else:
+                pipe.hgetall(key)
+
+        for key, result in zip(batch, pipe.execute(raise_on_error=False)):
+            if isinstance(result, redis.exceptions.ResponseError):
+                # WRONGTYPE, key is not a hash
+                continue
+            if fields:
+                result = {k : v for k, v in zip(fields, result) if v is not None}
+            yield key, result
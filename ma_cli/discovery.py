@@ -0,0 +1,211 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# seconds a service list is used before consul is asked again,
+# shared by the in-process and on-disk caches
+CACHE_TTL = 30
+CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                          "ma-cli",
+                          "services.json")
+# path of a yaml or json file of endpoints used instead of consul
+ENDPOINTS_ENV = "MA_CLI_ENDPOINTS"
+# how long a blocking query waits for changes
+WATCH_WAIT = "30s"
+# how long a refresh of an expired cache waits for changes
+REFRESH_WAIT = "100ms"
+
+_lock = threading.Lock()
+_cache = {"index" : None, "time" : 0, "services" : None}
+_static = {}
+
+def agent_address():
+    # caches are only shared by tools talking to the same agent
+    return os.environ.get("CONSUL_HTTP_ADDR", "")
+
+def parse_endpoint(service, endpoint):
+    # "host:port", [host, port] or {"ip" : host, "port" : port}
+    if isinstance(endpoint, str):
+        ip, port = endpoint.rsplit(":", 1)
+    elif isinstance(endpoint, dict):
+        ip, port = endpoint["ip"], endpoint["port"]
+    else:
+        ip, port = endpoint
+    return {"ip" : ip, "port" : int(port), "service" : service}
+
+def static_services(path=None):
+    """
+    return services from the endpoint file named by path or
+    MA_CLI_ENDPOINTS, None if neither is set
+
+    the file maps service names to endpoints:
+
+        redis: 127.0.0.1:6379
+        zerorpc-tools: {ip: 127.0.0.1, port: 4242}
+    """
+    if path is None:
+        path = os.environ.get(ENDPOINTS_ENV)
+    if not path:
+        return None
+    if path not in _static:
+        with open(path) as f:
+            if path.endswith(".json"):
+                endpoints = json.load(f)
+            else:
+                from ruamel.yaml import YAML
+                endpoints = YAML(typ='safe').load(f)
+        _static[path] = [parse_endpoint(service, endpoint) for service, endpoint in (endpoints or {}).items()]
+    return _static[path]
+
+def read_cache(path=CACHE_PATH):
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        if cached.get("agent") == agent_address():
+            return cached
+    except (OSError, ValueError):
+        pass
+    return None
+
+def write_cache(cached, path=CACHE_PATH):
+    # write to a temporary file and rename so other
+    # processes never read a partial file
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".services")
+        with os.fdopen(fd, "w") as f:
+            json.dump(dict(cached, agent=agent_address()), f)
+        os.replace(tmp_path, path)
+    except (OSError, TypeError, ValueError) as ex:
+        print("could not write cache {}: {}".format(path, ex), file=sys.stderr)
+
+def nomad_services(c, index, names):
+    """
+    return services registered by nomad under names from the
+    catalog, None if the catalog has moved past index while
+    they were being read
+    """
+    services = []
+    for name in names:
+        service_index, nodes = c.catalog.service(name)
+        if int(service_index) > int(index):
+            return None
+        for node in nodes:
+            if node["ServiceID"].startswith("_nomad"):
+                services.append({"ip" : node["ServiceAddress"] or node["Address"],
+                                 "port" : node["ServicePort"],
+                                 "service" : node["ServiceName"]})
+    return services
+
+def query(index=None, wait=None):
+    """
+    return (catalog index, services) from consul, services is
+    None if index is given and the catalog did not change
+    within wait
+
+    the services are read from the catalog and describe the
+    catalog at the returned index
+    """
+    import consul
+    c = consul.Consul()
+    while True:
+        new_index, names = c.catalog.services(index=index, wait=wait if index else None)
+        if index is not None and new_index == index:
+            return index, None
+        current = nomad_services(c, new_index, names)
+        if current is not None:
+            return new_index, current
+        # changed while reading, read again at the newer index
+        index, wait = None, None
+
+def store(index, services):
+    cached = {"index" : index, "time" : time.time(), "services" : services}
+    _cache.update(cached)
+    write_cache(cached)
+
+def services(max_age=CACHE_TTL):
+    """
+    return list of {'ip', 'port', 'service'} dicts, from the
+    static endpoint file if set, otherwise from the in-process
+    or on-disk cache if younger than max_age, otherwise consul
+    """
+    static = static_services()
+    if static is not None:
+        return static
+
+    with _lock:
+        now = time.time()
+        if _cache["services"] is not None and now - _cache["time"] < max_age:
+            return _cache["services"]
+
+        cached = read_cache()
+        if cached is not None and now - cached["time"] < max_age:
+            _cache.update(cached)
+            return _cache["services"]
+
+        if _cache["services"] is None and cached is not None:
+            _cache.update(cached)
+
+        try:
+            # an expired list is still current if the catalog
+            # has not moved past the index it was read at
+            index, current = query(_cache["index"], REFRESH_WAIT)
+            if current is None:
+                current = _cache["services"]
+            store(index, current)
+        except Exception as ex:
+            # a stale list is more useful than none
+            if _cache["services"] is None:
+                raise
+            print("using cached services, consul lookup failed: {}".format(ex), file=sys.stderr)
+        return _cache["services"]
+
+def catalog_index():
+    """
+    consul catalog index the cached services were read at,
+    None for static endpoints or before the first lookup
+    """
+    return _cache["index"]
+
+def invalidate():
+    """
+    forget cached services, ie after an endpoint stops responding
+    """
+    with _lock:
+        _cache.update({"index" : None, "time" : 0, "services" : None})
+        try:
+            os.remove(CACHE_PATH)
+        except OSError:
+            pass
+
+def watch_services(wait=WATCH_WAIT, retry=5):
+    """
+    yield the service list each time it changes using consul
+    blocking queries on the catalog index, caches are updated
+    before yielding
+
+    the first list is yielded immediately
+    """
+    index = None
+    while True:
+        try:
+            new_index, current = query(index, wait)
+            if current is None:
+                continue
+        except Exception as ex:
+            print("service watch failed: {}".format(ex), file=sys.stderr)
+            time.sleep(retry)
+            continue
+        with _lock:
+            store(new_index, current)
+        index = new_index
+        yield current
@@ -0,0 +1,114 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+# Closed form rectangles for cells of the grids drawn by
+# img_grid, img_column and img_row.
+#
+# grid cells are numbered down each column, then across:
+#
+#     0  3  6
+#     1  4  7
+#     2  5  8
+#
+# rectangles are (x, y, w, h). As with the original cell walk
+# a start or end cell outside the grid leaves that corner at 0.
+#
+# batch_* functions take arrays (or scalars) for every argument,
+# broadcast them against each other and return an (n, 4) array,
+# ie many cell ranges on one image size or one range on many sizes
+
+def cells(length, spacing):
+    # number of cells along an axis, the
+    # last one may be partially outside
+    return -(-length // spacing)
+
+def grid_rectangle(size, xspacing, yspacing, upper_left_square=0, lower_right_square=0):
+    imgw, imgh = size
+    rows = cells(imgh, yspacing)
+    count = cells(imgw, xspacing) * rows
+
+    x, y, x2, y2 = 0, 0, 0, 0
+    if 0 <= upper_left_square < count:
+        x = (upper_left_square // rows) * xspacing
+        y = (upper_left_square % rows) * yspacing
+    if 0 <= lower_right_square < count:
+        x2 = (lower_right_square // rows) * xspacing + xspacing
+        y2 = (lower_right_square % rows) * yspacing + yspacing
+
+    return (x, y, x2 - x, y2 - y)
+
+def column_rectangle(size, xspacing, left_column=0, right_column=0):
+    imgw, imgh = size
+    count = cells(imgw, xspacing)
+
+    x, y, x2, y2 = 0, 0, 0, 0
+    if 0 <= left_column < count:
+        x = left_column * xspacing
+    if 0 <= right_column < count:
+        x2 = right_column * xspacing + xspacing
+        y2 = imgh
+
+    return (x, y, x2 - x, y2 - y)
+
+def row_rectangle(size, yspacing, upper_row=0, lower_row=0):
+    imgw, imgh = size
+    count = cells(imgh, yspacing)
+
+    x, y, x2, y2 = 0, 0, 0, 0
+    if 0 <= upper_row < count:
+        y = upper_row * yspacing
+    if 0 <= lower_row < count:
+        x2 = imgw
+        y2 = lower_row * yspacing + yspacing
+
+    return (x, y, x2 - x, y2 - y)
+
+def batch_grid_rectangles(widths, heights, xspacing, yspacing, upper_left_squares, lower_right_squares):
+    import numpy as np
+    imgw, imgh, xspacing, yspacing, upper, lower = np.broadcast_arrays(
+        *[np.asarray(a, dtype=np.int64) for a in
+          (widths, heights, xspacing, yspacing, upper_left_squares, lower_right_squares)])
+    rows = -(-imgh // yspacing)
+    count = -(-imgw // xspacing) * rows
+
+    valid = (upper >= 0) & (upper < count)
+    x = np.where(valid, (upper // rows) * xspacing, 0)
+    y = np.where(valid, (upper % rows) * yspacing, 0)
+    valid = (lower >= 0) & (lower < count)
+    x2 = np.where(valid, (lower // rows) * xspacing + xspacing, 0)
+    y2 = np.where(valid, (lower % rows) * yspacing + yspacing, 0)
+
+    return np.stack([x, y, x2 - x, y2 - y], axis=-1).reshape(-1, 4)
+
+def batch_column_rectangles(widths, heights, xspacing, left_columns, right_columns):
+    import numpy as np
+    imgw, imgh, xspacing, left, right = np.broadcast_arrays(
+        *[np.asarray(a, dtype=np.int64) for a in
+          (widths, heights, xspacing, left_columns, right_columns)])
+    count = -(-imgw // xspacing)
+
+    zeros = np.zeros_like(imgw)
+    x = np.where((left >= 0) & (left < count), left * xspacing, 0)
+    valid = (right >= 0) & (right < count)
+    x2 = np.where(valid, right * xspacing + xspacing, 0)
+    y2 = np.where(valid, imgh, 0)
+
+    return np.stack([x, zeros, x2 - x, y2], axis=-1).reshape(-1, 4)
+
+def batch_row_rectangles(widths, heights, yspacing, upper_rows, lower_rows):
+    import numpy as np
+    imgw, imgh, yspacing, upper, lower = np.broadcast_arrays(
+        *[np.asarray(a, dtype=np.int64) for a in
+          (widths, heights, yspacing, upper_rows, lower_rows)])
+    count = -(-imgh // yspacing)
+
+    zeros = np.zeros_like(imgh)
+    y = np.where((upper >= 0) & (upper < count), upper * yspacing, 0)
+    valid = (lower >= 0) & (lower < count)
+    x2 = np.where(valid, imgw, 0)
+    y2 = np.where(valid, lower * yspacing + yspacing, 0)
+
+    return np.stack([zeros, y, x2, y2 - y], axis=-1).reshape(-1, 4)
@@ -0,0 +1,132 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+# decoded images are much larger than their
+# encoded blobs, ie a 20 megapixel rgb scan
+# is ~60MB once decoded
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+def fingerprint(length, head, tail):
+    """
+    cheap content fingerprint from the length and the
+    first / last bytes of a blob, so a changed blob can
+    be detected without transferring all of it
+    """
+    digest = hashlib.sha1()
+    digest.update(str(length).encode())
+    digest.update(head or b"")
+    digest.update(tail or b"")
+    return digest.hexdigest()
+
+def image_bytes(image):
+    return image.size[0] * image.size[1] * len(image.getbands())
+
+def private_copy(image):
+    """
+    return a copy of image that can be modified, ie with
+    pixel access or ImageDraw, without changing image
+
+    copies are owned by the caller and are not counted
+    against a cache's budget
+    """
+    handle = image.copy()
+    handle.format = image.format
+    return handle
+
+class ImageCache(object):
+    """LRU cache of decoded images bounded by a memory budget
+
+    entries are keyed by (binary key, fingerprint), storing a new
+    fingerprint for a binary key replaces the previous entry
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, key_fingerprint):
+        """
+        return a private copy or None
+        """
+        with self._lock:
+            image = self._entries.get((key, key_fingerprint))
+            if image is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((key, key_fingerprint))
+            self.hits += 1
+            return private_copy(image)
+
+    def put(self, key, key_fingerprint, image):
+        """
+        store a loaded image and return a private copy
+
+        images larger than the budget are not stored
+        """
+        size = image_bytes(image)
+        with self._lock:
+            previous = self._fingerprints.get(key)
+            if previous is not None:
+                self._remove((key, previous))
+
+            if size <= self.max_bytes:
+                self._entries[(key, key_fingerprint)] = image
+                self._fingerprints[key] = key_fingerprint
+                self.bytes += size
+                self._evict()
+
+        return private_copy(image)
+
+    def invalidate(self, key):
+        with self._lock:
+            previous = self._fingerprints.get(key)
+            if previous is not None:
+                self._remove((key, previous))
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._fingerprints.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries" : len(self._entries),
+                    "bytes" : self.bytes,
+                    "max_bytes" : self.max_bytes,
+                    "hits" : self.hits,
+                    "misses" : self.misses,
+                    "evictions" : self.evictions,
+                    "hit_rate" : self.hits / lookups if lookups else 0.0}
+
+    def _remove(self, entry):
+        image = self._entries.pop(entry, None)
+        if image is not None:
+            self.bytes -= image_bytes(image)
+            if self._fingerprints.get(entry[0]) == entry[1]:
+                del self._fingerprints[entry[0]]
+
+    def _evict(self):
+        # least recently used first
+        while self.bytes > self.max_bytes and self._entries:
+            entry = next(iter(self._entries))
+            self._remove(entry)
+            self.evictions += 1
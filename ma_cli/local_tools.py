@@ -4,39 +4,28 @@
 #
 # Copyright (c) 2017, Galen Curwen-McAdams
 
-import consul
-import zerorpc
+from ma_cli import discovery
+from ma_cli import rpc_pool
 
-def lookup(service):
-    c = consul.Consul()
-    services = {k:v for (k,v) in c.agent.services().items() if k.startswith("_nomad")}
-    for k in services.keys():
-        if services[k]['Service'] == service:
-                service_ip,service_port = services[k]['Address'],services[k]['Port']
-                return service_ip,service_port
-                break
+def lookup(service, max_age=discovery.CACHE_TTL):
+    for s in discovery.services(max_age):
+        if s['service'] == service:
+            return s['ip'], s['port']
+    # service may have started or moved since
+    # the cached list was fetched
+    if max_age > 0:
+        return lookup(service, max_age=0)
     return None,None
 
-def fuzzy_lookup(service):
-    c = consul.Consul()
-    matched_services = []
-    services = {k:v for (k,v) in c.agent.services().items() if k.startswith("_nomad")}
-    for k in services.keys():
-        if service in services[k]['Service']:
-                sinfo = {
-                'ip':services[k]['Address'],
-                'port':services[k]['Port'],
-                'service':services[k]['Service']
-                }
-                matched_services.append(sinfo)
-    return matched_services
+def fuzzy_lookup(service, max_age=discovery.CACHE_TTL):
+    found = [dict(s) for s in discovery.services(max_age) if service in s['service']]
+    if not found and max_age > 0:
+        return fuzzy_lookup(service, max_age=0)
+    return found
 
 def rpc(func,*args):
     rip,rport = lookup('zerorpc-tools')
-    zc = zerorpc.Client()
-    zc.connect("tcp://{}:{}".format(rip,rport))
-    result = zc(func,*args)
-    return result
+    return rpc_pool.clients.call((rip,rport), func, *args)
 
 def parse_job_output(job_string):
     jobs = {}
@@ -8,8 +8,6 @@ import sys
 import argparse
 import pathlib
 import subprocess
-from ruamel.yaml import YAML
-from curtsies import Input
 
 class Default(dict):
     def __missing__(self, key):
@@ -19,6 +17,7 @@ class Default(dict):
 def bind(yaml_files):
     bound = {}
     configuration = {}
+    from ruamel.yaml import YAML
     yaml = YAML(typ='safe')
 
     for file in yaml_files:
@@ -57,6 +56,7 @@ def prepare(call_string, configuration, lookup_attribute):
 def input_loop(bindings):
     loop_exit_bindings = (u'q', u'Q', u'<ESC>', u'<Ctrl-d>')
     active_attribute = "zoom"
+    from curtsies import Input
     with Input(keynames='curtsies') as input_generator:
         for e in Input():
 
@@ -6,14 +6,8 @@
 
 import sys
 import argparse
-from curtsies import Input
-import redis
-from lxml import etree
 from ma_cli import data_models
 
-r_ip, r_port = data_models.service_connection()
-binary_r = redis.StrictRedis(host=r_ip, port=r_port)
-redis_conn = redis.StrictRedis(host=r_ip, port=r_port, decode_responses=True)
 LOOP_EXIT_BINDINGS = (u'<ESC>', u'<Ctrl-d>')
 
 # originally named ma-tree
@@ -29,9 +23,10 @@ LOOP_EXIT_BINDINGS = (u'<ESC>', u'<Ctrl-d>')
 #  zero value
 
 def create_menu_trees(keys, menu_trees):
+    from lxml import etree
     trees = {}
     for key in keys:
-        contents = redis_conn.get(key)
+        contents = data_models.db.text.get(key)
         xml = etree.fromstring(contents)
         for item in menu_trees:
             attribs = []
@@ -61,7 +56,7 @@ def confirm_values(key, pair):
         if e in LOOP_EXIT_BINDINGS:
             break
         elif e in "Yy":
-            redis_conn.hmset(key, {pair[0]: pair[1]})
+            data_models.db.text.hset(key, pair[0], pair[1])
             print("done!")
             break
         elif e in "Nn":
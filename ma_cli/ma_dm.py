@@ -9,6 +9,51 @@ from ma_cli import data_models
 import subprocess
 import shlex
 import sys
+import time
+
+# seconds before --maintain-indexes reconnects after
+# losing its redis connection
+RECONNECT_DELAY = 5
+
+def bulk_summary(func, field_name, uuids, **kwargs):
+    start = time.perf_counter()
+    modified = func(field_name, uuids, **kwargs)
+    elapsed = time.perf_counter() - start
+    print(modified)
+    print("{} keys in {:.2f}s ({:.0f} keys/sec)".format(len(modified),
+                                                     elapsed,
+                                                     len(modified) / elapsed if elapsed else 0))
+
+def parse_cursor(token):
+    # a resume token is "cursor" or "cursor:offset"
+    # where offset keys of that scan page were listed
+    cursor, _, offset = str(token).partition(":")
+    try:
+        return int(cursor), int(offset or 0)
+    except ValueError:
+        raise ValueError("expected cursor or cursor:offset, got {}".format(token))
+
+def list_keys(pattern, scan_count, cursor=0, limit=None):
+    # yield hash keys, stopping after limit keys and
+    # printing the token to resume from to stderr
+    cursor, skip = parse_cursor(cursor)
+    listed = 0
+    if limit is not None and limit <= 0:
+        return
+    for page_cursor, next_cursor, keys in data_models.scan_pages(pattern, scan_count, "hash", cursor):
+        # keys of the resumed page already listed, a page
+        # rescanned with the same cursor and count is the
+        # same unless keys were added or removed meanwhile
+        offset, skip = skip, 0
+        for key_num, key in enumerate(keys[offset:], offset + 1):
+            yield key
+            listed += 1
+            if limit is not None and listed >= limit:
+                if key_num < len(keys):
+                    print("cursor: {}:{}".format(page_cursor, key_num), file=sys.stderr)
+                elif int(next_cursor) != 0:
+                    print("cursor: {}".format(next_cursor), file=sys.stderr)
+                return
 
 def main():
     """
@@ -39,25 +84,93 @@ def main():
     parser.add_argument("--remove-field", help = "remove field from all matching ---pattern")
     parser.add_argument("--field-values", nargs='+', default=[], help = "list of values to be randomly selected as value to field created by --add-field")
     parser.add_argument("--field-range", help = "populate field of all matching --pattern with increasing integers 1, 2, 3...")
+    parser.add_argument("--index", help = "build (or rebuild) an index for field on all keys with --prefix, indexes are used while --maintain-indexes runs")
+    parser.add_argument("--index-type", choices=data_models.data_index.INDEX_TYPES, default=data_models.data_index.STRING, help = "order field values as strings or numbers for --index")
+    parser.add_argument("--drop-index", help = "remove index for field on --prefix")
+    parser.add_argument("--maintain-indexes", action="store_true", help = "keep indexes for --prefix current with keys written by other services, indexes are only used while this runs")
+    parser.add_argument("--list-indexes", action="store_true", help = "list indexed fields for --prefix")
+    parser.add_argument("--preview-size", type=int, nargs=2, metavar=("WIDTH", "HEIGHT"), help = "decode images shown by --see-all or piped keys at reduced resolution to fit within WIDTH HEIGHT")
+    parser.add_argument("--workers", type=int, default=data_models.DECODE_WORKERS, help = "threads used to decode and modify images for --see-all or piped keys")
+    parser.add_argument("--output-dir", default=None, help = "write montage pages for --see-all or piped keys to this directory instead of displaying them")
+    parser.add_argument("--max-canvas", type=int, default=data_models.montage.MAX_CANVAS, help = "largest width or height of a montage page in pixels")
+    parser.add_argument("--columns", type=int, default=None, help = "montage columns, defaults to a square grid")
+    parser.add_argument("--limit", type=int, help = "list at most this many keys, the cursor to resume from is printed to stderr")
+    parser.add_argument("--cursor", default="0", help = "resume listing from a cursor or cursor:offset printed by --limit")
+    parser.add_argument("--unsorted", action="store_true", help = "print keys as they are scanned instead of sorted")
+    parser.add_argument("--scan-count", type=int, default=data_models.SCAN_COUNT, help = "keys requested per SCAN call")
+    parser.add_argument("--max-connections", type=int, default=data_models.connections.MAX_CONNECTIONS, help = "redis connections per pool, threads wait for a free connection once all are in use")
+    parser.add_argument("--socket-timeout", type=float, default=data_models.connections.SOCKET_TIMEOUT, help = "seconds to wait on a redis reply, waits indefinitely by default")
+    parser.add_argument("--batch-size", type=int, default=data_models.BATCH_SIZE, help = "number of keys written per pipelined round trip for --add-field, --remove-field and --field-range")
 
     args = parser.parse_args()
+    data_models.db.configure(max_connections=args.max_connections,
+                             socket_timeout=args.socket_timeout)
 
     if keys:
-        data_models.view_concatenate(keys, args.modify)
+        data_models.view_concatenate(keys,
+                                     args.modify,
+                                     max_size=args.preview_size,
+                                     workers=args.workers,
+                                     output_dir=args.output_dir,
+                                     max_canvas=args.max_canvas,
+                                     columns=args.columns)
         return
 
     if args.uuid is None:
-        if args.add_field:
-            print(data_models.add_field(args.add_field, data_models.enumerate_data(args.pattern),values=args.field_values))
+        if args.index:
+            indexed = data_models.create_index(args.prefix, args.index, args.index_type, batch_size=args.batch_size)
+            print("indexed {} keys for {}{}".format(indexed, args.prefix, args.index))
+            return
+        elif args.drop_index:
+            data_models.drop_index(args.prefix, args.drop_index)
+            return
+        elif args.maintain_indexes:
+            try:
+                while True:
+                    try:
+                        data_models.maintain_indexes(args.prefix)
+                        return
+                    except data_models.redis.exceptions.ConnectionError as ex:
+                        # redis may have been rescheduled, look it up
+                        # again and rebuild the indexes
+                        print("lost redis connection: {}, reconnecting in {}s".format(ex, RECONNECT_DELAY))
+                        data_models.db.reconnect()
+                        time.sleep(RECONNECT_DELAY)
+            except KeyboardInterrupt:
+                pass
+            return
+        elif args.list_indexes:
+            for field, field_type in sorted(data_models.list_indexes(args.prefix).items()):
+                print("{:<30}{}".format(field, field_type))
+            return
+        elif args.add_field:
+            bulk_summary(data_models.add_field,
+                         args.add_field,
+                         data_models.iterate_data(args.pattern, args.scan_count, key_type="hash"),
+                         values=args.field_values,
+                         batch_size=args.batch_size)
             return
         elif args.remove_field:
-            print(data_models.remove_field(args.remove_field, data_models.enumerate_data(args.pattern)))
+            bulk_summary(data_models.remove_field,
+                         args.remove_field,
+                         data_models.iterate_data(args.pattern, args.scan_count, key_type="hash"),
+                         batch_size=args.batch_size)
             return
         elif args.field_range:
-            print(data_models.range_field(args.field_range, data_models.enumerate_data(args.pattern)))
+            bulk_summary(data_models.range_field,
+                         args.field_range,
+                         data_models.iterate_data(args.pattern, args.scan_count, key_type="hash"),
+                         batch_size=args.batch_size)
             return
         else:
-            for data in sorted(data_models.enumerate_data(args.pattern)):
+            try:
+                parse_cursor(args.cursor)
+            except ValueError as ex:
+                parser.error(str(ex))
+            keys = list_keys(args.pattern, args.scan_count, args.cursor, args.limit)
+            if not args.unsorted:
+                keys = data_models.sorted_stream(keys)
+            for data in keys:
                 print(data)
             return
 
@@ -79,4 +192,10 @@ def main():
     elif args.see_all:
         data_model =  data_models.pretty_format(data_thing, args.uuid)
         general_prefix = args.prefix.strip(":")
-        data_models.view_concatenate([args.prefix + args.uuid], [])
+        data_models.view_concatenate([args.prefix + args.uuid],
+                                     [],
+                                     max_size=args.preview_size,
+                                     workers=args.workers,
+                                     output_dir=args.output_dir,
+                                     max_canvas=args.max_canvas,
+                                     columns=args.columns)
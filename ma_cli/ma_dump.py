@@ -7,7 +7,6 @@
 
 import argparse
 import redis
-from lxml import etree
 
 def dump(db_host, db_port, db_conn, dump_name="dump.xml"):
     # for light (uses a more centralized key structure):
@@ -21,6 +20,7 @@ def dump(db_host, db_port, db_conn, dump_name="dump.xml"):
     #
     # for heavy:
     #     not implemented
+    from lxml import etree
 
     # store in xml with machine as root
     dump = etree.Element("machine")
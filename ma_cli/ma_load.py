@@ -7,10 +7,91 @@
 
 import argparse
 import hashlib
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import redis
-from lxml import etree
 
-def load(filename, db_host, db_port, db_conn):
+# fields written per pipelined hset
+BATCH = 500
+# hosts written to at once
+WORKERS = 8
+
+def parse(filename):
+    """
+    yield (kind, field, value) for each route and script in
+    filename, elements are released once read
+    """
+    from lxml import etree
+
+    for _, element in etree.iterparse(filename, events=("end",), tag=("route", "script")):
+        value = element.get("raw")
+        if element.tag == "route":
+            # calculate route hash
+            yield "routes", hashlib.sha224(value.encode()).hexdigest(), value
+        else:
+            yield "scripts", element.get("name"), value
+        element.clear()
+        # drop already read siblings still held by the parent
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+def write(entries, db_host, db_port, db_conn, diff=False, batch=BATCH):
+    """
+    write (kind, field, value) entries with batched hsets, returns
+    {kind : {"added" : [fields], "changed" : [fields], "unchanged" : count}}
+
+    if diff is True the existing hashes are fetched once, only
+    added or changed fields are written and fields missing from
+    entries are reported as "stale" without being removed
+    """
+    keys = {"routes" : "machinic:routes:{}:{}".format(db_host, db_port),
+            "scripts" : "machinic:scripts:{}:{}".format(db_host, db_port)}
+    report = {kind : {"added" : [], "changed" : [], "stale" : [], "unchanged" : 0} for kind in keys}
+
+    existing = None
+    if diff is True:
+        pipe = db_conn.pipeline(transaction=False)
+        for key in keys.values():
+            pipe.hgetall(key)
+        existing = dict(zip(keys, pipe.execute()))
+
+    pending = {kind : {} for kind in keys}
+    queued = 0
+
+    def flush():
+        pipe = db_conn.pipeline(transaction=False)
+        for kind, mapping in pending.items():
+            if mapping:
+                pipe.hset(keys[kind], mapping=mapping)
+                mapping.clear()
+        pipe.execute()
+
+    for kind, field, value in entries:
+        if existing is not None:
+            current = existing[kind].pop(field, None)
+            if current == value:
+                report[kind]["unchanged"] += 1
+                continue
+            report[kind]["added" if current is None else "changed"].append(field)
+        else:
+            report[kind]["added"].append(field)
+        pending[kind][field] = value
+        queued += 1
+        if queued >= batch:
+            flush()
+            queued = 0
+
+    if queued:
+        flush()
+
+    if existing is not None:
+        for kind, fields in existing.items():
+            report[kind]["stale"] = sorted(fields)
+
+    return report
+
+def load(filename, db_host, db_port, db_conn, diff=False, batch=BATCH):
     # for light (uses a more centralized key structure):
     #     routes:
     #     machinic:routes:{}:{} (hash key)
@@ -22,35 +103,100 @@ def load(filename, db_host, db_port, db_conn):
     #
     # for heavy:
     #     not implemented
+    return write(parse(filename), db_host, db_port, db_conn, diff=diff, batch=batch)
+
+def print_report(report, diff=False):
+    for kind, changes in report.items():
+        if diff:
+            print("{:<30}{} added, {} changed, {} stale, {} unchanged".format(kind,
+                                                                             len(changes["added"]),
+                                                                             len(changes["changed"]),
+                                                                             len(changes["stale"]),
+                                                                             changes["unchanged"]))
+            for change in ("added", "changed", "stale"):
+                for field in changes[change]:
+                    print(" " * 4 + "{:<26}{}".format(change, field))
+        else:
+            print("{:<30}{} written".format(kind, len(changes["added"])))
+
+def push_one(entries, target, diff=False, batch=BATCH):
+    db_host, db_port = target
+    db_settings = {k : v for k, v in (("host", db_host), ("port", db_port)) if v is not None}
+    redis_conn = redis.StrictRedis(**db_settings, decode_responses=True)
+    try:
+        return write(entries, db_host, db_port, redis_conn, diff=diff, batch=batch)
+    finally:
+        redis_conn.connection_pool.disconnect()
 
-    routes_key = "machinic:routes:{}:{}".format(db_host, db_port)
-    scripts_key = "machinic:scripts:{}:{}".format(db_host, db_port)
-    xml = etree.parse(filename)
+def push(entries, targets, diff=False, batch=BATCH, workers=WORKERS):
+    """
+    write entries to each (db_host, db_port) target using a
+    pool of workers, yields (target, report, exception, latency)
+    as each host finishes
+    """
+    entries = list(entries)
 
-    for route in xml.xpath('//route'):
-        route_string = route.get("raw")
-        # calculate route hash
-        route_hash = hashlib.sha224(route_string.encode()).hexdigest()
-        db_conn.hmset(routes_key, {route_hash : route_string})
+    def timed(target):
+        start = time.time()
+        try:
+            return target, push_one(entries, target, diff, batch), None, time.time() - start
+        except Exception as ex:
+            return target, None, ex, time.time() - start
 
-    for script in xml.xpath('//script'):
-        script_string = script.get("raw")
-        script_name = script.get("name")
-        db_conn.hmset(scripts_key, {script_name : script_string})
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(targets) or 1))) as executor:
+        for future in as_completed([executor.submit(timed, target) for target in targets]):
+            yield future.result()
+
+def parse_target(target):
+    host, _, port = target.rpartition(":")
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError("expected host:port, got {}".format(target))
+    return host, int(port)
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("filename", help="xml file to load")
     parser.add_argument("--db-host",  help="db host ip, requires use of --db-port")
     parser.add_argument("--db-port", type=int, help="db port, requires use of --db-host")
+    parser.add_argument("--targets", default=[], nargs='+', type=parse_target, help="host:port of each db to load into")
+    parser.add_argument("-s", "--service", default=[], nargs='+', help="load into db services whose consul names contain these")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="hosts written to at once")
+    parser.add_argument("--diff", action="store_true", help="only write added or changed entries and report them")
+    parser.add_argument("--batch", type=int, default=BATCH, help="entries written per round trip")
     args = parser.parse_args()
 
     if bool(args.db_host) != bool(args.db_port):
         parser.error("--db-host and --db-port values are both required")
 
-    # pass connection into function
-    db_settings = {"host" :  args.db_host, "port" : args.db_port}
-    binary_r = redis.StrictRedis(**db_settings)
-    redis_conn = redis.StrictRedis(**db_settings, decode_responses=True)
+    targets = list(args.targets)
+    if args.db_host:
+        targets.append((args.db_host, args.db_port))
+    for service in args.service:
+        from ma_cli import local_tools
+        found = local_tools.fuzzy_lookup(service)
+        if not found:
+            print("no services matching {}".format(service))
+        targets.extend((s['ip'], int(s['port'])) for s in found)
+    # same db found through several options
+    targets = list(dict.fromkeys(targets))
+
+    if not targets:
+        if args.service:
+            sys.exit(1)
+        # default connection settings
+        targets = [(None, None)]
+
+    # parsed once for every host
+    entries = list(parse(args.filename))
+    failed = False
+    for target, report, ex, latency in push(entries, targets, diff=args.diff, batch=max(1, args.batch), workers=args.workers):
+        name = "{}:{}".format(*target) if target != (None, None) else "default"
+        if ex is not None:
+            failed = True
+            print("{:<30} \u2717  {:.3f}s  {}".format(name, latency, ex))
+            continue
+        print("{:<30} \u2713  {:.3f}s".format(name, latency))
+        print_report(report, args.diff)
 
-    load(args.filename, args.db_host, args.db_port, redis_conn)
+    if failed:
+        sys.exit(1)
@@ -6,7 +6,6 @@
 
 import argparse
 from ma_cli import data_models
-import redis
 
 class Default(dict):
     def __missing__(self, key):
@@ -23,9 +22,7 @@ def main():
 
     args = parser.parse_args()
     
-    r_ip, r_port = data_models.service_connection()
-    redis_conn = redis.StrictRedis(host=r_ip, port=str(r_port), decode_responses=True)
-    binary_redis_conn = redis.StrictRedis(host=r_ip, port=str(r_port))
+    redis_conn = data_models.db.text
 
     if args.project:
         for project in args.project:
@@ -7,9 +7,137 @@
 import argparse
 import subprocess
 from ma_cli import local_tools
-import zerorpc
+from ma_cli import rpc_pool
+from ma_cli import capabilities
 import pprint
 import sys
+import json
+import time
+import types
+
+# services called at once and seconds to wait for
+# each, None uses the client pool timeout
+CONCURRENCY = 32
+TIMEOUT = None
+
+def error_name(ex):
+    # remote errors carry the remote exception name
+    return getattr(ex, "name", type(ex).__name__)
+
+# marks the end of a service's results on its queue
+DONE = object()
+
+def throw(service, method, method_args, results, timeout=TIMEOUT):
+    """
+    call method on service and put (service, result, exception,
+    latency, streamed) on the results queue for the answer, the
+    error or each item of a streamed answer, followed by DONE
+    """
+    kwargs = {}
+    if timeout is not None:
+        kwargs["timeout"] = timeout
+    start = time.time()
+    try:
+        zc = rpc_pool.clients.get((service['ip'], service['port']))
+        result = zc(method, *method_args, **kwargs)
+        if isinstance(result, types.GeneratorType):
+            # methods decorated with @zerorpc.stream
+            # answer with a generator
+            for item in result:
+                results.put((service, item, None, time.time() - start, True))
+        else:
+            results.put((service, result, None, time.time() - start, False))
+    except Exception as ex:
+        results.put((service, None, ex, time.time() - start, False))
+    results.put(DONE)
+
+def throw_all(services, method, method_args, timeout=TIMEOUT, concurrency=CONCURRENCY, unordered=False):
+    """
+    call method on services concurrently in greenlets, yields
+    (service, result, exception, latency, streamed) as answers arrive, once
+    per item for streamed answers. Unless unordered, answers from
+    a service are held until earlier services are done
+    """
+    import gevent
+    from gevent.pool import Pool
+    from gevent.queue import Queue
+
+    services = list(services)
+    pool = Pool(concurrency)
+    if unordered:
+        queues = [Queue()] * len(services)
+    else:
+        queues = [Queue() for _ in services]
+
+    def spawn():
+        # spawning blocks while the pool is full
+        for service, results in zip(services, queues):
+            pool.spawn(throw, service, method, method_args, results, timeout)
+    gevent.spawn(spawn)
+
+    if unordered:
+        done = 0
+        while done < len(services):
+            answer = queues[0].get()
+            if answer is DONE:
+                done += 1
+            else:
+                yield answer
+    else:
+        for results in queues:
+            for answer in iter(results.get, DONE):
+                yield answer
+
+def write_result(result, streamed=False):
+    if isinstance(result, list) or streamed:
+        result = result if isinstance(result, list) else [result]
+        for result_item in result:
+            sys.stdout.write(str(result_item) +  '\n')
+            sys.stdout.flush()
+    else:
+        sys.stdout.write(str(result))
+        sys.stdout.flush()
+
+def to_json(value):
+    if isinstance(value, bytes):
+        return value.decode(errors="replace")
+    return str(value)
+
+def write_ndjson(service, result, ex, latency):
+    # one line per result item, tagged with
+    # the service and seconds since the call
+    if ex is not None:
+        lines = [{"service" : service['service'],
+                  "latency" : round(latency, 6),
+                  "error" : error_name(ex),
+                  "message" : str(ex)}]
+    else:
+        lines = [{"service" : service['service'],
+                  "latency" : round(latency, 6),
+                  "result" : item} for item in (result if isinstance(result, list) else [result])]
+    for line in lines:
+        sys.stdout.write(json.dumps(line, default=to_json) + '\n')
+    sys.stdout.flush()
+
+def print_capabilities(services, args):
+    errors = {}
+    exposed = capabilities.capabilities(services,
+                                        refresh=args.refresh,
+                                        timeout=args.timeout or capabilities.INSPECT_TIMEOUT,
+                                        concurrency=max(1, args.concurrency),
+                                        errors=errors,
+                                        backoff=not args.service)
+    for endpoint, entry in sorted(exposed.items(), key=lambda e: e[1]['service']):
+        print("{:<30}    {}".format(entry['service'], endpoint))
+        if entry['methods'] is None:
+            print(" " * 4 + "methods unknown, inspection raised {}".format(entry['error']))
+            continue
+        for method, info in sorted(entry['methods'].items()):
+            if method.startswith("_"):
+                continue
+            print(" " * 4 + "{:<30}{}".format(method, info.get('args', "")))
+    for service, error in errors.items():
+        print("{:<30} \u2717  {}".format(service, error))
 
 def main():
     """
@@ -17,58 +145,84 @@ def main():
     """
 
     parser = argparse.ArgumentParser(description=main.__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser.add_argument("throwables", default=[], nargs='+', help="stuff to throw")
+    parser.add_argument("throwables", default=[], nargs='*', help="stuff to throw")
     parser.add_argument("-s", "--service", default=[], nargs='+', help="specific service names to connect to")
     parser.add_argument("-v", "--verbose", action="store_true", help="verbose")
     parser.add_argument("--pretty", action="store_true", help="pretty print")
+    parser.add_argument("--ndjson", action="store_true", help="print a json object per result with service and latency")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT, help="seconds to wait for each service")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="services called at once")
+    parser.add_argument("--unordered", action="store_true", help="print results as services answer")
+    parser.add_argument("--capabilities", action="store_true", help="print methods exposed by each service")
+    parser.add_argument("--refresh", action="store_true", help="inspect services again instead of using cached capabilities")
+    parser.add_argument("--all", action="store_true", help="throw to every service, not only those exposing the method")
 
     args = parser.parse_args()
 
-    if args.throwables is None:
-        for s in local_tools.fuzzy_lookup("zerorpc-"):
+    if args.service:
+        services = []
+        for service in args.service:
+            services.extend(local_tools.fuzzy_lookup(service))
+    else:
+        services = local_tools.fuzzy_lookup("zerorpc-")
+
+    if args.capabilities:
+        print_capabilities(services, args)
+        return
+    elif not args.throwables:
+        for s in services:
             print("{service:<30}    {ip}:{port}".format(**s))
         return
     else:
 
         results = []
+        answered = set()
 
-        if args.service:
-            services = []
-            for service in args.service:
-                services.extend(local_tools.fuzzy_lookup(service))
-        else:
-            services = local_tools.fuzzy_lookup("zerorpc-")
+        if not args.all:
+            # skip services known not to expose the method,
+            # services named with --service are always tried
+            errors = {}
+            services = capabilities.providers(services,
+                                              args.throwables[0],
+                                              refresh=args.refresh,
+                                              timeout=args.timeout or capabilities.INSPECT_TIMEOUT,
+                                              concurrency=max(1, args.concurrency),
+                                              errors=errors,
+                                              backoff=not args.service)
+            for service, error in errors.items():
+                print("{:<30} \u2717  {}  skipped".format(service, error), file=sys.stderr)
+            if not services:
+                print("no reachable service exposes {}".format(args.throwables[0]), file=sys.stderr)
 
-        for s in services:
-            zc = zerorpc.Client()
-            zc.connect("tcp://{ip}:{port}".format(**s))
-            try:
-                result = getattr(zc, args.throwables[0])(*args.throwables[1:])
-                results.append(result)
-                if args.verbose:
-                    print("{:<30} \u2713".format(s['service']))
-                    for r in result:
-                        print(" " * 4 + "{}".format(str(r)))
-            except Exception as ex:
+        for s, result, ex, latency, streamed in throw_all(services,
+                                                          args.throwables[0],
+                                                          args.throwables[1:],
+                                                          timeout=args.timeout,
+                                                          concurrency=max(1, args.concurrency),
+                                                          unordered=args.unordered):
+            if args.ndjson:
+                write_ndjson(s, result, ex, latency)
+                continue
+
+            if ex is not None:
                 if args.verbose:
-                    print("{:<30} \u2717  {}".format(s['service'], ex.name))
+                    print("{:<30} \u2717  {}".format(s['service'], error_name(ex)))
+                continue
+
             if args.verbose:
-                print()
+                # streamed items arrive one at a time
+                if s['service'] not in answered:
+                    print("{:<30} \u2713".format(s['service']))
+                    answered.add(s['service'])
+                for r in (result if isinstance(result, list) else [result]):
+                    print(" " * 4 + "{}".format(str(r)))
 
-        if args.pretty:
+            if args.pretty:
+                results.append(result)
+            elif not args.verbose:
+                write_result(result, streamed)
+
+        if args.pretty and not args.ndjson:
             print()
             pprint.pprint(results,indent=4)
             print()
-            return
-        elif args.verbose:
-            return
-        else:
-            for result in results:
-                if isinstance(result, list):
-                    for result_item in result:
-                        sys.stdout.write(str(result_item) +  '\n')
-                        sys.stdout.flush()
-                else:
-                    sys.stdout.write(str(result))
-                    sys.stdout.flush()
-
@@ -5,9 +5,6 @@
 # Copyright (c) 2018, Galen Curwen-McAdams
 
 import argparse
-from lings import pipeling
-from lings import routeling
-from ma_cli import visualize
 import subprocess
 
 def main():
@@ -15,14 +12,28 @@ def main():
     Visualize state of running lings, services, machines...
     """
     parser = argparse.ArgumentParser(description=main.__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser.add_argument("--pattern", required=False,help="filter generated graph")
+    parser.add_argument("--pattern", required=False,help="only graph channels, pipes, calls and services matching pattern and their neighbours")
+    parser.add_argument("--hops", type=int, default=1, help="edges followed from nodes matching --pattern")
     parser.add_argument("--self-document", action='store_true', required=False,help="generates sanitized svg for README")
+    parser.add_argument("--timeout", type=float, default=5, help="seconds to wait for each service's inspection")
+    parser.add_argument("--watch", action='store_true', help="render again when routes, pipes or services change")
+    parser.add_argument("--watch-keys", nargs='+', default=["*route*", "*pipe*"], help="key patterns watched for changes")
+    parser.add_argument("--debounce", type=float, default=1, help="seconds without changes before rendering")
 
     args = parser.parse_args()
+    # lings and zerorpc are only loaded once arguments are parsed
+    from ma_cli import visualize
 
     if args.self_document:
         git_rev = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode()
         title="ma-vis@{}".format(git_rev)
-        visualize.graph_display(file="ma-vis-screenshot", **{'sanitize':True,'title':title })
+        visualize.graph_display(file="ma-vis-screenshot", **{'sanitize':True,'title':title,'timeout':args.timeout,'pattern':args.pattern,'hops':args.hops })
 
-    visualize.graph_display()
\ No newline at end of file
+    if args.watch:
+        try:
+            visualize.watch(timeout=args.timeout, patterns=args.watch_keys, debounce=args.debounce, pattern=args.pattern, hops=args.hops)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    visualize.graph_display(timeout=args.timeout, pattern=args.pattern, hops=args.hops)
\ No newline at end of file
@@ -0,0 +1,152 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import math
+import os
+import time
+
+# largest width or height of a montage page
+MAX_CANVAS = 4096
+BORDER = 50
+
+class Montage(object):
+    """Lay images out on a grid of square cells
+
+    images are downsampled to fit their cell and pasted as they
+    are added, pages are at most max_canvas pixels on either side.
+    With an output_dir each full page is written to disk and
+    released, with on_page each full page is handed to it as
+    soon as it is finished, so memory is bounded by a single page.
+
+    page files are named after the run, by default montage and
+    the start time, and existing files are never overwritten
+    """
+    def __init__(self,
+                 count,
+                 max_canvas=MAX_CANVAS,
+                 columns=None,
+                 border=BORDER,
+                 background=(0, 0, 0),
+                 output_dir=None,
+                 name=None,
+                 on_page=None):
+        self.count = max(1, count)
+        self.border = border
+        self.background = background
+        self.output_dir = output_dir
+        self.on_page = on_page
+        if name is None:
+            name = "montage_{}".format(time.strftime("%Y%m%d_%H%M%S"))
+        if output_dir is not None:
+            # runs started within the same second
+            # or reusing a name get a suffix
+            run_name = name
+            suffix = 1
+            while os.path.exists(os.path.join(output_dir, "{}_{:04d}.png".format(run_name, 0))):
+                suffix += 1
+                run_name = "{}_{}".format(name, suffix)
+            name = run_name
+        self.name = name
+        self.finished = 0
+
+        if columns is None:
+            columns = math.ceil(math.sqrt(self.count))
+        self.columns = max(1, min(columns, self.count))
+        # shrink borders for very wide grids so
+        # cells always have some room
+        if border * (self.columns + 1) >= max_canvas:
+            self.border = max(0, max_canvas // (self.columns * 10))
+        self.cell = max(1, (max_canvas - self.border * (self.columns + 1)) // self.columns)
+        self.rows_per_page = max(1, (max_canvas - self.border) // (self.cell + self.border))
+
+        self.added = 0
+        self.page = None
+        self.pages = []
+
+    @property
+    def cell_size(self):
+        return (self.cell, self.cell)
+
+    @property
+    def per_page(self):
+        return self.columns * self.rows_per_page
+
+    def _new_page(self):
+        from PIL import Image
+        remaining = max(1, self.count - self.added)
+        rows = min(self.rows_per_page, math.ceil(remaining / self.columns))
+        columns = min(self.columns, remaining)
+        size = (self.border + columns * (self.cell + self.border),
+                self.border + rows * (self.cell + self.border))
+        self.page = Image.new("RGB", size, self.background)
+        self.page_used = (0, 0)
+
+    def add(self, img):
+        """
+        fit img into the next cell, img itself is not modified
+        """
+        if self.page is None:
+            self._new_page()
+
+        slot = self.added % self.per_page
+        column, row = slot % self.columns, slot // self.columns
+
+        from PIL import Image
+        tile = img
+        if img.size[0] > self.cell or img.size[1] > self.cell:
+            scale = min(self.cell / img.size[0], self.cell / img.size[1])
+            tile = img.resize((max(1, int(img.size[0] * scale)),
+                               max(1, int(img.size[1] * scale))),
+                              Image.LANCZOS)
+        if tile.mode not in ("RGB", "L"):
+            tile = tile.convert("RGB")
+
+        # center tile in its cell
+        x = self.border + column * (self.cell + self.border) + (self.cell - tile.size[0]) // 2
+        y = self.border + row * (self.cell + self.border) + (self.cell - tile.size[1]) // 2
+        self.page.paste(tile, (x, y))
+        self.page_used = (max(self.page_used[0], column + 1), max(self.page_used[1], row + 1))
+        if tile is not img:
+            tile.close()
+
+        self.added += 1
+        if self.added % self.per_page == 0:
+            self._finish_page()
+
+    def _finish_page(self):
+        # crop unused cells if fewer images arrived than expected
+        columns, rows = self.page_used
+        size = (self.border + columns * (self.cell + self.border),
+                self.border + rows * (self.cell + self.border))
+        page = self.page
+        if size != page.size:
+            page = page.crop((0, 0) + size)
+            self.page.close()
+        self.page = None
+
+        if self.output_dir is not None:
+            os.makedirs(self.output_dir, exist_ok=True)
+            filename = os.path.join(self.output_dir,
+                                    "{}_{:04d}.png".format(self.name, self.finished))
+            # fails rather than overwriting an existing page
+            with open(filename, "xb") as f:
+                page.save(f, "PNG")
+            page.close()
+            self.pages.append(filename)
+        elif self.on_page is not None:
+            self.on_page(page)
+        else:
+            self.pages.append(page)
+        self.finished += 1
+
+    def finish(self):
+        """
+        return list of pages, as filenames if output_dir is set,
+        empty if pages were handed to on_page, otherwise as images
+        """
+        if self.page is not None:
+            self._finish_page()
+        return self.pages
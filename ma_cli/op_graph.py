@@ -0,0 +1,158 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import hashlib
+from collections import OrderedDict
+from PIL import Image
+from ma_cli import image_cache
+
+# intermediate images kept for reuse
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+class OpGraph(object):
+    """Ordered image operations applied lazily to a base image
+
+    each intermediate image is memoized under a hash of the base
+    and the ops leading to it, so after editing, removing or
+    reordering an op rendering restarts from the last unchanged
+    step instead of from the base
+
+    apply(img, method, args) performs an op and returns an image,
+    it may modify img in place since it is given a private
+    copy of any memoized image
+
+    consecutive ops whose methods are in batched are performed
+    together by apply_batch(img, [(method, args)...]) in a
+    single pass, only the image after the whole run is memoized
+    """
+    def __init__(self, apply, max_bytes=DEFAULT_MAX_BYTES, apply_batch=None, batched=()):
+        self.apply = apply
+        self.apply_batch = apply_batch
+        self.batched = set(batched) if apply_batch is not None else set()
+        self.max_bytes = max_bytes
+        self.ops = []
+        self.base = None
+        self._base_hash = None
+        self._generation = 0
+        self._memo = OrderedDict()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __iter__(self):
+        return iter(self.ops)
+
+    def __getitem__(self, index):
+        return self.ops[index]
+
+    def set_base(self, image, label=""):
+        """
+        start from a new base image, ops are kept so the same
+        edits can be rendered over a different field or a fresh
+        copy of the image, clear() them when switching to an
+        unrelated image
+        """
+        if image is self.base:
+            return
+        self.base = image
+        self._generation += 1
+        self._base_hash = hashlib.sha1("{}:{}".format(label, self._generation).encode()).hexdigest()
+
+    def append(self, method, args):
+        self.ops.append((method, tuple(args)))
+
+    def insert(self, index, method, args):
+        self.ops.insert(index, (method, tuple(args)))
+
+    def edit(self, index, args):
+        method, _ = self.ops[index]
+        self.ops[index] = (method, tuple(args))
+
+    def remove(self, index):
+        return self.ops.pop(index)
+
+    def move(self, from_index, to_index):
+        self.ops.insert(to_index, self.ops.pop(from_index))
+
+    def undo(self):
+        if self.ops:
+            return self.ops.pop()
+
+    def clear(self):
+        self.ops = []
+
+    def forget(self):
+        self._memo.clear()
+        self._bytes = 0
+
+    def prefix_hashes(self):
+        # hash of base plus ops[:i + 1] for each i
+        hashes = []
+        previous = self._base_hash
+        for method, args in self.ops:
+            digest = hashlib.sha1(previous.encode())
+            digest.update(repr((method, args)).encode())
+            previous = digest.hexdigest()
+            hashes.append(previous)
+        return hashes
+
+    def render(self):
+        """
+        return (image, number of ops applied) for the
+        current ops, reusing memoized intermediates
+        """
+        if self.base is None:
+            return None, 0
+
+        hashes = self.prefix_hashes()
+        start = 0
+        img = self.base
+        for i in range(len(hashes) - 1, -1, -1):
+            if hashes[i] in self._memo:
+                self._memo.move_to_end(hashes[i])
+                img = self._memo[hashes[i]]
+                start = i + 1
+                break
+
+        applied = 0
+        i = start
+        while i < len(self.ops):
+            method, args = self.ops[i]
+            end = i + 1
+            if method in self.batched:
+                while end < len(self.ops) and self.ops[end][0] in self.batched:
+                    end += 1
+            try:
+                if method in self.batched:
+                    result = self.apply_batch(image_cache.private_copy(img), self.ops[i:end])
+                else:
+                    result = self.apply(image_cache.private_copy(img), method, args)
+            except Exception as ex:
+                print("op {} {} failed: {}".format(i, method, ex))
+                result = None
+            if isinstance(result, Image.Image):
+                img = result
+            applied += end - i
+            self._remember(hashes[end - 1], img)
+            i = end
+
+        return image_cache.private_copy(img), applied
+
+    def _remember(self, key, img):
+        if key in self._memo:
+            return
+        self._memo[key] = img
+        self._bytes += image_cache.image_bytes(img)
+        while self._bytes > self.max_bytes and self._memo:
+            _, evicted = self._memo.popitem(last=False)
+            self._bytes -= image_cache.image_bytes(evicted)
+
+    def stats(self):
+        return {"ops" : len(self.ops),
+                "memoized" : len(self._memo),
+                "bytes" : self._bytes,
+                "max_bytes" : self.max_bytes}
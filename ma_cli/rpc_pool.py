@@ -0,0 +1,123 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import atexit
+import threading
+import time
+
+# zerorpc defaults, seconds
+HEARTBEAT = 5
+TIMEOUT = 30
+# clients unused for IDLE_EXPIRY seconds are closed,
+# clients unused for CHECK_AFTER seconds are pinged
+# before being reused
+IDLE_EXPIRY = 300
+CHECK_AFTER = 30
+PING_TIMEOUT = 2
+
+def endpoint(ip, port):
+    return "tcp://{}:{}".format(ip, port)
+
+class ClientPool(object):
+    """Connected zerorpc clients keyed by endpoint
+
+    a client is created and connected on first use of an endpoint
+    and reused afterwards, calls through one client are multiplexed
+    over a single zmq socket. A client that failed or stopped
+    answering pings is replaced on next use.
+    """
+    def __init__(self,
+                 heartbeat=HEARTBEAT,
+                 timeout=TIMEOUT,
+                 idle_expiry=IDLE_EXPIRY,
+                 check_after=CHECK_AFTER):
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.idle_expiry = idle_expiry
+        self.check_after = check_after
+        self.created = 0
+        self.reused = 0
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, address):
+        """
+        return a connected client for address, either an
+        endpoint string or an (ip, port) pair
+        """
+        if not isinstance(address, str):
+            address = endpoint(*address)
+        self.expire()
+
+        with self._lock:
+            entry = self._clients.get(address)
+        if entry is not None:
+            client, last_used = entry
+            if time.time() - last_used > self.check_after and not self.healthy(client):
+                self.discard(address)
+                entry = None
+
+        if entry is None:
+            import zerorpc
+            client = zerorpc.Client(heartbeat=self.heartbeat, timeout=self.timeout)
+            client.connect(address)
+            self.created += 1
+        else:
+            self.reused += 1
+
+        with self._lock:
+            self._clients[address] = (client, time.time())
+        return client
+
+    def call(self, address, method, *args, **kwargs):
+        """
+        call method on address, the client is dropped if the
+        remote is lost or the call times out
+        """
+        import zerorpc
+        client = self.get(address)
+        try:
+            return client(method, *args, **kwargs)
+        except (zerorpc.LostRemote, zerorpc.TimeoutExpired):
+            self.discard(address if isinstance(address, str) else endpoint(*address))
+            raise
+
+    def healthy(self, client):
+        try:
+            client._zerorpc_ping(timeout=PING_TIMEOUT)
+            return True
+        except Exception:
+            return False
+
+    def discard(self, address):
+        with self._lock:
+            entry = self._clients.pop(address, None)
+        if entry is not None:
+            entry[0].close()
+
+    def expire(self):
+        now = time.time()
+        with self._lock:
+            idle = [address for address, (_, last_used) in self._clients.items()
+                    if now - last_used > self.idle_expiry]
+        for address in idle:
+            self.discard(address)
+
+    def close(self):
+        with self._lock:
+            addresses = list(self._clients)
+        for address in addresses:
+            self.discard(address)
+
+    def stats(self):
+        with self._lock:
+            return {"clients" : len(self._clients),
+                    "created" : self.created,
+                    "reused" : self.reused}
+
+# process-wide pool
+clients = ClientPool()
+atexit.register(clients.close)
@@ -0,0 +1,110 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import argparse
+import subprocess
+import sys
+
+# modules behind console scripts
+ENTRY_POINTS = ("ma_cli.ma_cli",
+                "ma_cli.ma_deck",
+                "ma_cli.ma_dm",
+                "ma_cli.ma_sink",
+                "ma_cli.ma_dial",
+                "ma_cli.ma_vis",
+                "ma_cli.ma_throw",
+                "ma_cli.ma_dump",
+                "ma_cli.ma_load")
+
+# heavy or service specific packages that should only be
+# imported by the code paths using them, not at startup
+DEFERRED = ("PIL",
+            "numpy",
+            "zerorpc",
+            "gevent",
+            "zmq",
+            "paho",
+            "cmd2",
+            "consul",
+            "lxml",
+            "lings",
+            "curtsies",
+            "ruamel")
+
+# cumulative import time allowed per entry point,
+# importing redis alone takes most of it
+BUDGET_MS = 300
+
+def import_times(module):
+    """
+    import module in a fresh interpreter, returns
+    {imported module : cumulative microseconds}
+    """
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if output.returncode != 0:
+        raise ImportError(output.stderr.strip().split("\n")[-1])
+
+    times = {}
+    # import time: self [us] | cumulative | imported package
+    for line in output.stderr.split("\n"):
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        try:
+            times[name.strip()] = int(cumulative)
+        except ValueError:
+            pass
+    return times
+
+def measure(module, repeat=3):
+    """
+    return (milliseconds, deferred packages imported) using
+    the fastest of repeat runs to reduce noise
+    """
+    best = None
+    for _ in range(repeat):
+        times = import_times(module)
+        if best is None or times.get(module, 0) < best.get(module, 0):
+            best = times
+    loaded = sorted(name for name in best if name.split(".")[0] in DEFERRED and "." not in name)
+    return best.get(module, 0) / 1000, loaded
+
+def main():
+    """
+    measure startup import time of console scripts, exits
+    nonzero if any is over budget or imports a deferred package
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs='*', default=ENTRY_POINTS, help="modules to measure")
+    parser.add_argument("--budget", type=float, default=BUDGET_MS, help="milliseconds allowed per module")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per module, fastest is used")
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        try:
+            elapsed, loaded = measure(module, args.repeat)
+        except ImportError as ex:
+            print("{:<30}{}".format(module, ex))
+            failed = True
+            continue
+
+        problems = []
+        if elapsed > args.budget:
+            problems.append("over budget")
+        if loaded:
+            problems.append("imports {}".format(", ".join(loaded)))
+        if problems:
+            failed = True
+        print("{:<30}{:>8.1f}ms  {}".format(module, elapsed, "; ".join(problems) or "ok"))
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
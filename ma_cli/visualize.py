@@ -1,11 +1,30 @@
 from lings import pipeling
 from lings import routeling
+import fnmatch
+import os
+import queue
 import subprocess
-import zerorpc
+import threading
+import time
+from ma_cli import local_tools
+from ma_cli import capabilities
+from ma_cli import discovery
+from ma_cli import rpc_pool
 
-def graph_ecosystem(title="",sanitize=False):
+# seconds to wait for each service's inspection
+INSPECT_TIMEOUT = 5
+DOT_FILE = "/tmp/graph.dot"
+SVG_FILE = "/tmp/graph.svg"
+# edges followed from nodes matching a pattern
+HOPS = 1
+# keys whose changes trigger a rebuild in watch mode
+WATCH_KEYS = ("*route*", "*pipe*")
+# changes closer together than DEBOUNCE seconds are
+# rendered once, waiting at most MAX_DELAY seconds
+DEBOUNCE = 1
+MAX_DELAY = 10
 
-    graph_key = """
+GRAPH_KEY = """
     subgraph cluster_key {
         label="Key";
         fillcolor=blue
@@ -21,8 +40,45 @@ def graph_ecosystem(title="",sanitize=False):
     }
     """
 
-    graph = "digraph graphname {\n"
-    route_calls = []
+def matches(name, pattern):
+    return fnmatch.fnmatch(name, pattern) or pattern in name
+
+def prune(statements, names, pattern, hops=HOPS):
+    """
+    return the nodes matching pattern and those within hops
+    edges of them
+
+    statements are (nodes, line) pairs, an edge has two nodes,
+    names maps nodes to the name matched against
+    """
+    neighbours = {}
+    for nodes, _ in statements:
+        if len(nodes) == 2:
+            a, b = nodes
+            neighbours.setdefault(a, set()).add(b)
+            neighbours.setdefault(b, set()).add(a)
+
+    kept = set(node for node, name in names.items() if matches(name, pattern))
+    frontier = kept
+    for _ in range(hops):
+        frontier = set(n for node in frontier for n in neighbours.get(node, ())) - kept
+        kept |= frontier
+    return kept
+
+def graph_lines(sanitize=False,timeout=INSPECT_TIMEOUT,pattern=None,hops=HOPS):
+    """
+    return the statements of the ecosystem graph as a list of
+    lines, without the surrounding digraph, title or key
+
+    if pattern is given only channels, pipes and calls matching it
+    and their neighbours within hops are kept, and only services
+    whose name matches or whose cached methods are called from the
+    kept nodes are inspected
+    """
+    # (nodes, line) pairs, pruned before services are looked at
+    statements = []
+    names = {}
+    calls = set()
 
     routes = routeling.get_routes("*")
     for route in routes:
@@ -43,73 +99,232 @@ def graph_ecosystem(title="",sanitize=False):
                 rcompare_string = "{1}{0}".format(r.right_compare.comparator_value,r.right_compare.comparator_symbol.symbol)
 
             channel_node = r.channel.replace("/","FSLASH")
+            names[channel_node] = r.channel
 
             lnode = "{0}{1}".format(channel_node,hash(lcompare_string))
             rnode = "{0}{1}".format(channel_node,hash(rcompare_string))
-            graph += '{0} [label="{1}", style=filled, fillcolor=lightskyblue1]\n'.format(channel_node,r.channel)
+            statements.append(((channel_node,), '{0} [label="{1}", style=filled, fillcolor=lightskyblue1]\n'.format(channel_node,r.channel)))
             #graph += '{0} [label="{1}"]\n'.format(hash(args),args)
             if r.action == "pipe":
-                graph += '{0} -> {1} [label="{2}", color=lightskyblue1]\n'.format(channel_node,args.split("\n")[0],lcompare_string + " x " + rcompare_string + " "+args)
+                target = args.split("\n")[0]
+                statements.append(((channel_node, target), '{0} -> {1} [label="{2}", color=lightskyblue1]\n'.format(channel_node,target,lcompare_string + " x " + rcompare_string + " "+args)))
             else:
-                graph += '{} -> {} [label="{}", color=lightskyblue1]\n'.format(channel_node,r.action,lcompare_string + " x " + rcompare_string + " "+args)
-            route_calls.append(r.action)
+                target = r.action
+                statements.append(((channel_node, target), '{} -> {} [label="{}", color=lightskyblue1]\n'.format(channel_node,r.action,lcompare_string + " x " + rcompare_string + " "+args)))
+            names.setdefault(target, target)
+            calls.add(r.action)
 
     pipes = pipeling.get_pipes("*")
 
     for p in pipes:
         print(p.name)
-        graph += '{0} [label="{0}", style=filled, fillcolor=lightskyblue3]\n'.format(p.name)
+        names[p.name] = p.name
+        statements.append(((p.name,), '{0} [label="{0}", style=filled, fillcolor=lightskyblue3]\n'.format(p.name)))
         for step in p.pipe_steps:
             print(step.call)
-            route_calls.append(step.call)
-            graph += '{0} [label="{0}"]\n'.format(step.call,step.call)
+            names.setdefault(step.call, step.call)
+            calls.add(step.call)
+            statements.append(((step.call,), '{0} [label="{0}"]\n'.format(step.call,step.call)))
             args = [arg.arg for arg in step.args]
-            graph += '{} -> {} [label="{}"]\n'.format(p.name,step.call,args)
+            statements.append(((p.name, step.call), '{} -> {} [label="{}"]\n'.format(p.name,step.call,args)))
 
             #graph += '{0} [label="{0}"]\n'.format(step.call,step.call)
         print(args)
 
-    for service in routeling.fuzzy_lookup('zerorpc-'):
-        try:
-            zc = zerorpc.Client()
-            print(service)
-            zc.connect("tcp://{}:{}".format(service['ip'],service['port']))
-            #result = zc("_zerorpc_inspect")
-            result = zc._zerorpc_inspect()
-            #print(result)
-            for k,v in result['methods'].items():
-                if k in route_calls:
-                    #print(v['args'])
-                    if sanitize is True:
-                        ip = "".join([ s if s == "." else "x" for s in service['ip'] ])
-                        port = "".join([ s if s == "." else "x" for s in str(service['port']) ])
-                        graph += '{0} [label="{1}",style="dotted"]\n'.format("rpc"+k,k+"\n{}\n{}\n".format(ip,port))
-                    else:
-                        graph += '{0} [label="{1}",style="dotted"]\n'.format("rpc"+k,k+"\n{}\n{}\n".format(service['ip'],service['port']))
-
-                    graph += '{0} -> {1} [label="rpc",style="dotted"]\n'.format(k,"rpc"+k)
+    if pattern is not None:
+        kept = prune(statements, names, pattern, hops)
+        statements = [(nodes, line) for nodes, line in statements if kept.issuperset(nodes)]
+    else:
+        kept = set(names)
 
-        except Exception as ex:
-            print(ex)
+    # lines are collected and joined once
+    graph = [line for _, line in statements]
+    route_calls = calls & kept
 
-    # func -> rpc -> machine
-    graph+= 'labelloc="t";'
-    graph+= 'label="{}";'.format(title)
+    # services are inspected concurrently and inspections are
+    # cached until consul registrations change
+    services = local_tools.fuzzy_lookup('zerorpc-')
+    if pattern is not None:
+        # services not known to expose a kept call are
+        # left alone unless their name matches
+        known = capabilities.cached(services)
+        services = [s for s in services
+                    if matches(s['service'], pattern)
+                    or route_calls.intersection(known.get(rpc_pool.endpoint(s['ip'], s['port']), {}).get('methods') or {})]
+    errors = {}
+    exposed = capabilities.capabilities(services, timeout=timeout, errors=errors)
+    for service in services:
+        entry = exposed.get(rpc_pool.endpoint(service['ip'],service['port']))
+        if entry is None:
+            print(service, errors.get(service['service']))
+            continue
+        if entry['methods'] is None:
+            print(service, entry['error'])
+            continue
+        print(service)
+        for k,v in entry['methods'].items():
+            if k in route_calls:
+                #print(v['args'])
+                if sanitize is True:
+                    ip = "".join([ s if s == "." else "x" for s in service['ip'] ])
+                    port = "".join([ s if s == "." else "x" for s in str(service['port']) ])
+                    graph.append('{0} [label="{1}",style="dotted"]\n'.format("rpc"+k,k+"\n{}\n{}\n".format(ip,port)))
+                else:
+                    graph.append('{0} [label="{1}",style="dotted"]\n'.format("rpc"+k,k+"\n{}\n{}\n".format(service['ip'],service['port'])))
 
-    graph += graph_key
-    graph += "}"
+                graph.append('{0} -> {1} [label="rpc",style="dotted"]\n'.format(k,"rpc"+k))
 
     return graph
 
-def graph_display(file=None,**kwargs):
-    graph = graph_ecosystem(**kwargs)
+def render_graph(lines,title=""):
+    graph = ["digraph graphname {\n"]
+    graph.extend(lines)
+    # func -> rpc -> machine
+    graph.append('labelloc="t";')
+    graph.append('label="{}";'.format(title))
+
+    graph.append(GRAPH_KEY)
+    graph.append("}")
+
+    return "".join(graph)
+
+def graph_ecosystem(title="",sanitize=False,timeout=INSPECT_TIMEOUT,pattern=None,hops=HOPS):
+    return render_graph(graph_lines(sanitize,timeout,pattern,hops),title)
+
+def layout(graph, dot_file=DOT_FILE, svg_file=SVG_FILE):
+    """
+    write graph and lay it out as svg with dot, returns False
+    without running dot if graph is unchanged since last layout
+    """
+    try:
+        with open(dot_file) as f:
+            unchanged = (f.read() == graph and
+                         os.path.getmtime(svg_file) >= os.path.getmtime(dot_file))
+    except OSError:
+        unchanged = False
+    if unchanged:
+        return False
 
-    with open("/tmp/graph.dot","w+") as f:
+    with open(dot_file,"w+") as f:
         f.write(graph)
 
-    subprocess.call("dot /tmp/graph.dot -Grankdir=LR -Tsvg -o /tmp/graph.svg".split(" "))
+    subprocess.call("dot {} -Grankdir=LR -Tsvg -o {}".format(dot_file,svg_file).split(" "))
+    return True
+
+def graph_display(file=None,**kwargs):
+    graph = graph_ecosystem(**kwargs)
+
+    layout(graph)
 
-    subprocess.call(["display","/tmp/graph.svg"])
+    subprocess.call(["display",SVG_FILE])
 
     if file is not None:
         subprocess.call("dot /tmp/graph.dot -Grankdir=LR -Tsvg -o {}.svg".format(file).split(" "))
+
+class GraphModel(object):
+    """Statements of the last built graph
+
+    a rebuild that only reorders statements is not
+    a structural change and needs no new layout
+    """
+    def __init__(self):
+        self.lines = []
+        self.statements = frozenset()
+
+    def update(self, lines):
+        """
+        replace lines, returns (added, removed) statements
+        """
+        statements = frozenset(lines)
+        added = statements - self.statements
+        removed = self.statements - statements
+        self.lines = lines
+        self.statements = statements
+        return added, removed
+
+def watch_keys(changes, patterns=WATCH_KEYS):
+    """
+    put keyspace notifications for keys matching
+    patterns on changes, runs until the connection fails
+    """
+    # share the connection pool of the data model
+    from ma_cli import data_models
+    conn = data_models.db.text
+    try:
+        events = conn.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+        if "K" not in events:
+            print("keyspace notifications are disabled, enable with:")
+            print("    redis-cli config set notify-keyspace-events KA")
+    except Exception as ex:
+        print("could not check keyspace notifications: {}".format(ex))
+
+    pubsub = conn.pubsub(ignore_subscribe_messages=True)
+    pubsub.psubscribe(*["__keyspace@*__:{}".format(pattern) for pattern in patterns])
+    for message in pubsub.listen():
+        changes.put(message["channel"])
+
+def watch_catalog(changes):
+    """
+    put a change on changes when consul services change
+    """
+    watched = discovery.watch_services()
+    # first list is the current one
+    next(watched)
+    for _ in watched:
+        changes.put("services")
+
+def supervise(changes, target, args, retry=5):
+    """
+    run target(*args) until interrupted, restarting it retry
+    seconds after it fails or returns, a change is put on
+    changes after each restart since events may have been missed
+    """
+    while True:
+        try:
+            target(*args)
+            print("{} stopped, restarting in {}s".format(target.__name__, retry))
+        except Exception as ex:
+            print("{} failed: {}, restarting in {}s".format(target.__name__, ex, retry))
+        time.sleep(retry)
+        changes.put("restarted {}".format(target.__name__))
+
+def wait_for_changes(changes, debounce=DEBOUNCE, max_delay=MAX_DELAY):
+    """
+    block until a change arrives, then until no further
+    change arrives for debounce seconds, returns changes
+    """
+    received = [changes.get()]
+    start = time.time()
+    while time.time() - start < max_delay:
+        try:
+            received.append(changes.get(timeout=debounce))
+        except queue.Empty:
+            break
+    return received
+
+def watch(title="",sanitize=False,timeout=INSPECT_TIMEOUT,patterns=WATCH_KEYS,debounce=DEBOUNCE,pattern=None,hops=HOPS):
+    """
+    render the graph and render it again whenever routes, pipes
+    or services change, layout only runs if the structure changed
+    """
+    changes = queue.Queue()
+    for target, args in ((watch_keys, (changes, patterns)), (watch_catalog, (changes,))):
+        threading.Thread(target=supervise, args=(changes, target, args), daemon=True).start()
+
+    model = GraphModel()
+    viewer = None
+    try:
+        while True:
+            added, removed = model.update(graph_lines(sanitize,timeout,pattern,hops))
+            if added or removed:
+                print("{} statements added, {} removed".format(len(added), len(removed)))
+                layout(render_graph(model.lines,title))
+            # display reloads the svg when it changes,
+            # it is restarted if it was closed
+            if viewer is None or viewer.poll() is not None:
+                viewer = subprocess.Popen(["display","-update","1",SVG_FILE])
+            received = wait_for_changes(changes, debounce)
+            print("{} changes".format(len(received)))
+    finally:
+        if viewer is not None and viewer.poll() is None:
+            viewer.terminate()
@@ -20,8 +20,10 @@ name="ma cli",
                       "redis",
                       "ruamel.yaml",
                       "zerorpc",
+                      "gevent",
                       "lxml",
-                      "lings"
+                      "lings",
+                      "numpy"
                      ],
     dependency_links=["https://github.com/galencm/machinic-lings/tarball/master#egg=lings-0.1"],
     entry_points = {'console_scripts': ['ma-cli = ma_cli.ma_cli:main',
@@ -0,0 +1,30 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+from PIL import Image
+from ma_cli import data_models
+
+def overlapping(img):
+    compositor = data_models.Compositor()
+    compositor.rectangle(10, 10, 40, 40, 255, 0, 0, 100)
+    compositor.rectangle(30, 30, 40, 40, 0, 200, 0, 150)
+    compositor.rectangle(20, 20, 20, 20, 0, 0, 255, 50)
+    return compositor.render(img)
+
+def test_overlapping_rectangles_stack_the_same_for_rgb_and_rgba():
+    rgb = overlapping(Image.new("RGB", (80, 80), (20, 120, 40)))
+    rgba = overlapping(Image.new("RGBA", (80, 80), (20, 120, 40, 255)))
+
+    for point in ((15, 15), (35, 35), (45, 45), (60, 60), (5, 5)):
+        expected = rgb.getpixel(point)
+        found = rgba.getpixel(point)
+        assert found[3] == 255
+        assert all(abs(a - b) <= 1 for a, b in zip(expected, found[:3])), (point, expected, found)
+
+def test_rgba_rectangles_keep_transparency_outside():
+    img = overlapping(Image.new("RGBA", (80, 80), (0, 0, 0, 0)))
+    assert img.getpixel((75, 75)) == (0, 0, 0, 0)
+    assert img.getpixel((35, 35))[3] > img.getpixel((15, 15))[3]
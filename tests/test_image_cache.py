@@ -0,0 +1,23 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+from PIL import Image
+from ma_cli import image_cache
+
+def test_pixel_writes_leave_cached_entry_unchanged():
+    cache = image_cache.ImageCache()
+    image = Image.new("RGB", (4, 4), (10, 20, 30))
+
+    stored = cache.put("glworb_binary:1", "f", image)
+    stored.load()[0, 0] = (255, 0, 0)
+
+    handle = cache.get("glworb_binary:1", "f")
+    assert handle.getpixel((0, 0)) == (10, 20, 30)
+    handle.load()[1, 1] = (0, 255, 0)
+
+    assert image.getpixel((0, 0)) == (10, 20, 30)
+    assert image.getpixel((1, 1)) == (10, 20, 30)
+    assert cache.get("glworb_binary:1", "f").getpixel((1, 1)) == (10, 20, 30)
@@ -0,0 +1,67 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import io
+import types
+from PIL import Image
+from ma_cli import data_models
+from ma_cli import image_cache
+
+class FetchCounter(object):
+    """Binary connection serving blobs and counting
+    the blobs fetched with GET
+    """
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.fetched = 0
+
+    def pipeline(self, transaction=False):
+        return Pipeline(self)
+
+class Pipeline(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.commands = []
+
+    def strlen(self, key):
+        self.commands.append(lambda: len(self.conn.blobs.get(key, b"")))
+
+    def getrange(self, key, start, end):
+        self.commands.append(lambda: self.conn.blobs.get(key, b"")[start:end + 1 or None])
+
+    def get(self, key):
+        def get():
+            self.conn.fetched += 1
+            return self.conn.blobs.get(key)
+        self.commands.append(get)
+
+    def execute(self, raise_on_error=True):
+        return [command() for command in self.commands]
+
+def png(value):
+    file = io.BytesIO()
+    Image.new("L", (8, 8), value).save(file, "PNG")
+    return file.getvalue()
+
+def test_blobs_are_fetched_at_most_twice_workers_ahead(monkeypatch):
+    blobs = {"glworb_binary:{}".format(i) : png(i) for i in range(50)}
+    conn = FetchCounter(blobs)
+    monkeypatch.setattr(data_models, "db", types.SimpleNamespace(binary=conn))
+    monkeypatch.setattr(data_models, "decoded_images", image_cache.ImageCache())
+
+    workers = 3
+    keys = sorted(blobs, key=lambda key: int(key.split(":")[1]))
+    yielded = 0
+    for value, image in enumerate(data_models.load_images(keys + ["missing"], workers=workers)):
+        if value < len(blobs):
+            assert image.getpixel((0, 0)) == value
+        else:
+            assert image is None
+        yielded += 1
+        assert conn.fetched - yielded <= 2 * workers
+
+    assert yielded == len(blobs) + 1
+    assert conn.fetched == len(blobs)